@@ -0,0 +1,161 @@
+import numpy as np
+import utilities
+
+#--BATCH SETTLEMENT--#
+#Settles many games at once for replaying history (rebuilding a guild's ledger, analytics over months of games).
+#Games come in as columnar arrays (one row per player, games delimited by offsets) instead of lists of lists, debts are
+#computed for every game with one vectorized subtraction, and games with the same number of unpaired debts share one
+#NumPy subset-sum table and one layered DP, so the exponential part runs in C over a whole batch of games.
+#Produces the same number of transactions as utilities.poker_debt_settlement_algo.
+
+#structured dtype of the returned transactions, one row per payment
+TRANSACTION_DTYPE = np.dtype([("game", np.int64), ("debtor", np.int64), ("recipient", np.int64), ("amount_cents", np.int64)])
+
+#max cells (games * 2^players) of one batch's subset-sum table, bounds memory to about 10 bytes per cell
+BATCH_TABLE_CELLS = 1 << 22
+
+#number of players -> (list per popcount layer of (layer masks, list per player bit of (positions in layer, masks without the bit)))
+layer_cache = {}
+
+
+def get_layers(n):
+    """Masks of an n player table grouped by popcount, so each DP layer only reads the finished layer below it."""
+    if n in layer_cache:
+        return layer_cache[n]
+
+    masks = np.arange(1 << n, dtype=np.int64)
+    popcounts = np.zeros(1 << n, dtype=np.int8)
+    for i in range(n):
+        popcounts += ((masks >> i) & 1).astype(np.int8)
+
+    layers = []
+    for size in range(1, n + 1):
+        layer = masks[popcounts == size]
+        bits = []
+        for i in range(n):
+            positions = np.flatnonzero((layer >> i) & 1)
+            bits.append((positions, layer[positions] ^ (1 << i)))
+        layers.append((layer, bits))
+
+    layer_cache[n] = layers
+    return layers
+
+
+def batch_zero_sum_packing(debts):
+    """
+    Exact maximum zero-sum set packing (the DP of utilities.exact_zero_sum_packing) for a batch of games with the same
+    number of debts. debts is an int64 array of shape (games, n), every row summing to zero.
+    Return value: list per game of lists of tuples of column indices, each a zero-sum set, covering every column
+    """
+    games, n = debts.shape
+    if n == 0:
+        return [[] for g in range(games)]
+
+    #subset sums of every game at once: the masks with bit i set are the masks below it plus debt i
+    sums = np.zeros((games, 1 << n), dtype=np.int64)
+    for i in range(n):
+        sums[:, 1 << i:1 << (i + 1)] = sums[:, :1 << i] + debts[:, i:i + 1]
+    zero = sums == 0
+
+    dp = np.zeros((games, 1 << n), dtype=np.int8)
+    for layer, bits in get_layers(n):
+        best = np.zeros((games, len(layer)), dtype=np.int8)
+        for positions, previous in bits:
+            best[:, positions] = np.maximum(best[:, positions], dp[:, previous])
+        dp[:, layer] = best + zero[:, layer]
+
+    #walk back down from the full set per game, closing a set every time the remaining mask sums to zero
+    full = (1 << n) - 1
+    results = []
+    for g in range(games):
+        game_dp = dp[g]
+        game_zero = zero[g]
+        zero_sum_sets = []
+        mask = full
+        group = []
+        while mask:
+            target = game_dp[mask] - game_zero[mask]
+            for i in range(n):
+                bit = 1 << i
+                if mask & bit and game_dp[mask ^ bit] == target:
+                    group.append(i)
+                    mask ^= bit
+                    break
+
+            if game_zero[mask]:
+                zero_sum_sets.append(tuple(sorted(group)))
+                group = []
+        results.append(zero_sum_sets)
+
+    return results
+
+
+def games_to_columns(games):
+    """
+    Convert a list of games (each a list of [player_id, buy_in_cents, winnings_cents] rows) to the columnar arrays settle_games takes.
+    Return value: (game_offsets, player_ids, buy_in_cents, winnings_cents)
+    """
+    game_offsets = np.zeros(len(games) + 1, dtype=np.int64)
+    np.cumsum([len(game) for game in games], out=game_offsets[1:])
+    rows = np.array([row for game in games for row in game], dtype=np.int64).reshape(-1, 3)
+    return game_offsets, rows[:, 0], rows[:, 1], rows[:, 2]
+
+
+def settle_games(game_offsets, player_ids, buy_in_cents, winnings_cents, exact_max_players=utilities.EXACT_SETTLEMENT_MAX_PLAYERS):
+    """
+    Settle every game of a batch. Player rows of game g are rows game_offsets[g]:game_offsets[g + 1] of the three
+    int64 columns (game_offsets has one more entry than there are games).
+    Games with more than exact_max_players unpaired debts use the bounded heuristic of utilities.get_zero_sum_sets.
+    Return value: (TRANSACTION_DTYPE array of every game's transactions in game order, bool array that is False for games
+    that do not sum to zero and so have no transactions)
+    """
+    game_offsets = np.asarray(game_offsets, dtype=np.int64)
+    player_ids = np.asarray(player_ids, dtype=np.int64)
+    debts = np.asarray(buy_in_cents, dtype=np.int64) - np.asarray(winnings_cents, dtype=np.int64)
+
+    game_count = len(game_offsets) - 1
+    game_of_row = np.repeat(np.arange(game_count), np.diff(game_offsets))
+    totals = np.zeros(game_count, dtype=np.int64)
+    np.add.at(totals, game_of_row, debts)
+    valid = totals == 0
+
+    #players who owe and receive nothing are dropped, like utilities.get_player_debts
+    keep = (debts != 0) & valid[game_of_row]
+    kept_games = game_of_row[keep]
+    kept_players = player_ids[keep].tolist()
+    kept_debts = debts[keep].tolist()
+    kept_offsets = np.searchsorted(kept_games, np.arange(game_count + 1)).tolist()
+
+    #pair opposite debts per game, then group the games by how many debts are left for the exponential search
+    zero_sum_sets = [None] * game_count #game -> list of tuples of indices into that game's kept rows
+    by_size = {} #unpaired count -> (list of games, list of their unpaired indices)
+    for g in range(game_count):
+        game_debts = kept_debts[kept_offsets[g]:kept_offsets[g + 1]]
+        pairs, remaining = utilities.pair_opposite_debts(game_debts)
+        zero_sum_sets[g] = list(pairs)
+        if len(remaining) > exact_max_players:
+            heuristic_sets, chosen_k = utilities.get_zero_sum_sets([game_debts[i] for i in remaining], exact_max_players=0)
+            zero_sum_sets[g].extend(tuple(remaining[i] for i in group) for group in heuristic_sets)
+        elif len(remaining) > 0:
+            batch_games, batch_remaining = by_size.setdefault(len(remaining), ([], []))
+            batch_games.append(g)
+            batch_remaining.append(remaining)
+
+    for n, (batch_games, batch_remaining) in by_size.items():
+        chunk = max(1, BATCH_TABLE_CELLS >> n)
+        for start in range(0, len(batch_games), chunk):
+            chunk_games = batch_games[start:start + chunk]
+            chunk_remaining = batch_remaining[start:start + chunk]
+            values = np.array([[kept_debts[kept_offsets[g] + i] for i in remaining] for g, remaining in zip(chunk_games, chunk_remaining)], dtype=np.int64)
+            for g, remaining, game_sets in zip(chunk_games, chunk_remaining, batch_zero_sum_packing(values)):
+                zero_sum_sets[g].extend(tuple(remaining[i] for i in group) for group in game_sets)
+
+    #within each zero-sum set a greedy pass decides who pays who, like poker_debt_settlement_algo
+    rows = []
+    for g in range(game_count):
+        offset = kept_offsets[g]
+        for group in zero_sum_sets[g]:
+            for debtor, recipient, amount_cents in utilities.greedy([[kept_players[offset + i], kept_debts[offset + i]] for i in group]):
+                rows.append((g, debtor, recipient, amount_cents))
+
+    return np.array(rows, dtype=TRANSACTION_DTYPE), valid
@@ -0,0 +1,332 @@
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+from itertools import combinations
+import utilities
+import settlement_cache
+
+#--SETTLEMENT BENCHMARK--#
+#Runs poker_debt_settlement_algo (and the greedy baseline) over seeded random and adversarial debt vectors from 2 to 30
+#players and records wall time, peak memory, transaction count against the optimum and the k the heuristic reached.
+#The optimum comes from a brute-force partition search (up to BRUTE_FORCE_MAX_PLAYERS players) or from planted groups,
+#never from the exact DP being measured.
+#Usage: python benchmark.py [--output results.json] [--baseline previous.json] [--max-players 30] [--repeats 3] [--check]
+#With --baseline it exits with status 1 if any case got slower than the allowed tolerance or needed more transactions.
+#With --check it first compares the exact DP, ZeroSumSubsetIndex and SettlementCache against brute force on seeded
+#games, checks large games through the heuristic, the greedy fallback and (with NumPy) batch_settlement, and exits with
+#status 1 on any mismatch.
+
+BRUTE_FORCE_MAX_PLAYERS = 12 #O(3^n) partition search
+
+
+def random_debts(rng, n):
+    """Uniform random debts up to $100 that sum to zero."""
+    debts = [rng.randint(-10000, 10000) for i in range(n - 1)]
+    debts.append(-sum(debts))
+    return debts
+
+
+def equal_magnitude_debts(rng, n):
+    """Everyone won or lost the same few amounts (fixed buy-ins), lots of equal and opposite debts."""
+    amounts = [2000, 4000, 6000]
+    debts = [rng.choice(amounts) * rng.choice([-1, 1]) for i in range(n - 1)]
+    debts.append(-sum(debts))
+    return debts
+
+
+def planted_groups_debts(rng, n):
+    """Disjoint zero-sum groups of 2 to 4 players, shuffled. Returns (debts, number of planted groups)."""
+    debts = []
+    groups = 0
+    while len(debts) < n:
+        size = min(rng.randint(2, 4), n - len(debts))
+        if size == 1: #can't make a group of one, fold the last player into the previous group
+            debts[-1] -= 1
+            debts.append(1)
+            break
+        group = [rng.randint(1, 10000) * rng.choice([-1, 1]) for i in range(size - 1)]
+        group.append(-sum(group))
+        if group[-1] == 0:
+            continue
+        debts.extend(group)
+        groups += 1
+    rng.shuffle(debts)
+    return debts, groups
+
+
+def repeated_amounts_debts(rng, n):
+    """Debts drawn from a few buy-in sized amounts, so many subsets sum to zero without being opposite pairs."""
+    amounts = [500, 1000, 1500, 2000, 2500, 3000, 3700, 4100]
+    debts = [rng.choice(amounts) * rng.choice([-1, 1]) for i in range(n - 1)]
+    debts.append(-sum(debts))
+    return debts
+
+
+def near_zero_trap_debts(rng, n):
+    """Many subsets that miss zero by a single cent, the case float epsilon comparisons get wrong."""
+    base = rng.randint(1000, 5000)
+    debts = [base + rng.choice([-1, 0, 1]) if i % 2 == 0 else -base for i in range(n - 1)]
+    debts.append(-sum(debts))
+    return debts
+
+
+def brute_force_max_zero_sum_sets(debts):
+    """
+    Maximum number of zero-sum sets the debts (summing to zero) can be partitioned into, by trying every zero-sum set
+    that contains the lowest remaining debt and recursing on the rest. Independent of utilities' DP and pairing.
+    """
+    full = (1 << len(debts)) - 1
+    sums = {}
+    best = {0: 0}
+
+    def subset_sum(mask):
+        if mask not in sums:
+            sums[mask] = sum(debt for i, debt in enumerate(debts) if mask >> i & 1)
+        return sums[mask]
+
+    def search(mask):
+        if mask not in best:
+            low = mask & -mask
+            rest = mask ^ low
+            result = None
+            submask = rest
+            while True: #every submask of rest, so every set containing low
+                group = submask | low
+                if subset_sum(group) == 0:
+                    found = search(mask ^ group)
+                    if found != None and (result == None or found + 1 > result):
+                        result = found + 1
+                if submask == 0:
+                    break
+                submask = (submask - 1) & rest
+            best[mask] = result
+        return best[mask]
+
+    return search(full)
+
+
+def optimal_transactions(debts):
+    """Minimum number of transactions for nonzero debts, or None if there are too many for the brute-force search."""
+    if len(debts) > BRUTE_FORCE_MAX_PLAYERS:
+        return None
+    return len(debts) - brute_force_max_zero_sum_sets(debts)
+
+
+def measure(function, game_data, repeats):
+    """Best wall time over repeats and peak traced memory of one run. Return value: (result, seconds, peak bytes)"""
+    best = None
+    for i in range(repeats):
+        rows = [list(row) for row in game_data] #the algorithms sort and update their input in place
+        start = time.perf_counter()
+        result = function(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+
+    tracemalloc.start()
+    function([list(row) for row in game_data])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, best, peak
+
+
+def run_case(kind, n, seed, repeats):
+    rng = random.Random(f"{kind}-{n}-{seed}")
+    planted = None
+    if kind == "random":
+        debts = random_debts(rng, n)
+    elif kind == "equal_magnitude":
+        debts = equal_magnitude_debts(rng, n)
+    elif kind == "planted_groups":
+        debts, planted = planted_groups_debts(rng, n)
+    else:
+        debts = near_zero_trap_debts(rng, n)
+
+    #a debt is a buy-in with no winnings (a credit a negative buy-in), player ids are just positions
+    game_data = [[i, debt, 0] for i, debt in enumerate(debts)]
+    nonzero = sum(1 for debt in debts if debt != 0)
+
+    stats = {}
+    transactions, seconds, peak = measure(lambda rows: utilities.poker_debt_settlement_algo(rows, stats), game_data, repeats)
+    greedy_transactions, greedy_seconds, greedy_peak = measure(utilities.greedy_debt_settlement, game_data, repeats)
+
+    optimum = optimal_transactions([debt for debt in debts if debt != 0])
+    if optimum == None and planted != None:
+        optimum_source = "planted_bound" #planted groups give an upper bound on the optimum
+        optimum = nonzero - planted
+    else:
+        optimum_source = "brute_force" if optimum != None else None
+
+    return {
+        "kind": kind,
+        "players": n,
+        "seed": seed,
+        "seconds": seconds,
+        "peak_bytes": peak,
+        "transactions": len(transactions),
+        "optimum": optimum,
+        "optimum_source": optimum_source,
+        "chosen_k": stats.get("chosen_k"),
+        "greedy_seconds": greedy_seconds,
+        "greedy_transactions": len(greedy_transactions),
+    }
+
+
+def settles_debts(game_data, transactions):
+    """Whether the [debtor, recipient, amount_cents] transactions pay off exactly every player's buy-in minus winnings."""
+    owed = {player_id: buy_in - winnings for player_id, buy_in, winnings in game_data}
+    for transaction in transactions:
+        if not isinstance(transaction, (list, tuple)) or len(transaction) != 3:
+            return False
+        debtor, recipient, amount_cents = transaction
+        if amount_cents <= 0 or debtor not in owed or recipient not in owed:
+            return False
+        owed[debtor] -= amount_cents
+        owed[recipient] += amount_cents
+    return all(debt == 0 for debt in owed.values())
+
+
+def check_against_brute_force(games=300, large_games=100, seed=0):
+    """
+    Compare the exact DP, ZeroSumSubsetIndex and the SettlementCache mapping against brute force on seeded small games,
+    then check that the heuristic (more than EXACT_SETTLEMENT_MAX_PLAYERS unpaired debts) and the greedy fallback settle
+    seeded 17 to 60 player games (too big for an optimum, so only that every debt is paid in at most n - 1 payments),
+    and that batch_settlement agrees on those games when NumPy is installed.
+    Return value: list of human readable mismatches
+    """
+    rng = random.Random(seed)
+    generators = [random_debts, equal_magnitude_debts, lambda rng, n: planted_groups_debts(rng, n)[0], near_zero_trap_debts]
+    cache = settlement_cache.SettlementCache()
+    mismatches = []
+
+    for g in range(games):
+        n = rng.randint(2, BRUTE_FORCE_MAX_PLAYERS)
+        debts = [debt for debt in rng.choice(generators)(rng, n) if debt != 0]
+        name = f"game {g} debts={debts}"
+
+        #exact DP: valid partition with the brute-force number of sets
+        packing = utilities.exact_zero_sum_packing(debts)
+        covered = sorted(i for group in packing for i in group)
+        if covered != list(range(len(debts))) or any(sum(debts[i] for i in group) != 0 for group in packing):
+            mismatches.append(f"{name}: exact_zero_sum_packing returned an invalid partition {packing}")
+        elif len(packing) != brute_force_max_zero_sum_sets(debts):
+            mismatches.append(f"{name}: exact_zero_sum_packing found {len(packing)} sets, brute force {brute_force_max_zero_sum_sets(debts)}")
+
+        #subset index: exactly the zero-sum combinations of each size, in combinations order
+        index = utilities.ZeroSumSubsetIndex(debts)
+        for size in range(2, len(debts) + 1):
+            expected = [subset for subset in combinations(range(len(debts)), size) if sum(debts[i] for i in subset) == 0]
+            if index.subsets_of_size(size) != expected:
+                mismatches.append(f"{name}: ZeroSumSubsetIndex size {size} differs from brute force")
+
+        #settlement cache: the same shape under other player ids and row order maps back to a valid optimal settlement
+        game_data = [[i, max(debt, 0), max(-debt, 0)] for i, debt in enumerate(debts)]
+        transactions = utilities.poker_debt_settlement_algo([list(row) for row in game_data])
+        if not settles_debts(game_data, transactions) or len(transactions) != optimal_transactions(debts):
+            mismatches.append(f"{name}: poker_debt_settlement_algo returned {transactions}, optimum is {optimal_transactions(debts)} transactions")
+            continue
+
+        cache.set(game_data, transactions)
+        ids = rng.sample(range(10_000, 20_000), len(debts))
+        relabeled = [[ids[player_id], buy_in, winnings] for player_id, buy_in, winnings in game_data]
+        rng.shuffle(relabeled)
+        cached = cache.get(relabeled)
+        if cached == None or not settles_debts(relabeled, cached) or len(cached) != len(transactions):
+            mismatches.append(f"{name}: cached settlement {cached} does not settle the relabeled game {relabeled}")
+
+    large = []
+    for g in range(large_games):
+        debts = [debt for debt in rng.choice([repeated_amounts_debts, random_debts])(rng, rng.randint(17, 60)) if debt != 0]
+        game_data = [[i, max(debt, 0), max(-debt, 0)] for i, debt in enumerate(debts)]
+        large.append(game_data)
+        name = f"large game {g} ({len(debts)} players)"
+        for algorithm in [utilities.poker_debt_settlement_algo, utilities.greedy_debt_settlement]:
+            transactions = algorithm([list(row) for row in game_data])
+            if not settles_debts(game_data, transactions) or len(transactions) > len(debts) - 1:
+                mismatches.append(f"{name}: {algorithm.__name__} returned {transactions}, which does not settle debts={debts}")
+
+    #the NumPy batch path (only if requirements-tools.txt is installed) must settle the same games in as many transactions
+    try:
+        import batch_settlement
+    except ImportError:
+        return mismatches
+
+    transactions, valid = batch_settlement.settle_games(*batch_settlement.games_to_columns(large))
+    for g, game_data in enumerate(large):
+        batch = [[int(row["debtor"]), int(row["recipient"]), int(row["amount_cents"])] for row in transactions[transactions["game"] == g]]
+        expected = len(utilities.poker_debt_settlement_algo([list(row) for row in game_data]))
+        if not settles_debts(game_data, batch) or len(batch) != expected:
+            mismatches.append(f"large game {g}: batch_settlement.settle_games returned {batch}, poker_debt_settlement_algo needs {expected} transactions")
+
+    return mismatches
+
+
+def compare(results, baseline, time_tolerance):
+    """Return a list of human readable regressions of results against a baseline run."""
+    previous = {(case["kind"], case["players"], case["seed"]): case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        old = previous.get((case["kind"], case["players"], case["seed"]))
+        if old == None:
+            continue
+        name = f'{case["kind"]} n={case["players"]} seed={case["seed"]}'
+        if case["transactions"] > old["transactions"]:
+            regressions.append(f'{name}: {old["transactions"]} -> {case["transactions"]} transactions')
+        if case["seconds"] > old["seconds"] * time_tolerance and case["seconds"] - old["seconds"] > 0.005: #ignore noise on sub-5ms cases
+            regressions.append(f'{name}: {old["seconds"] * 1000:.1f}ms -> {case["seconds"] * 1000:.1f}ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the poker debt settlement algorithm")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="previous results JSON to check for regressions")
+    parser.add_argument("--min-players", type=int, default=2)
+    parser.add_argument("--max-players", type=int, default=30)
+    parser.add_argument("--seeds", type=int, default=3, help="cases per kind and player count")
+    parser.add_argument("--repeats", type=int, default=3, help="timing runs per case (best is kept)")
+    parser.add_argument("--time-tolerance", type=float, default=1.5, help="allowed slowdown factor against the baseline")
+    parser.add_argument("--check", action="store_true", help="first check the exact DP, subset index and settlement cache against brute force")
+    args = parser.parse_args()
+
+    if args.check:
+        mismatches = check_against_brute_force()
+        for mismatch in mismatches:
+            print(f"MISMATCH {mismatch}")
+        if len(mismatches) > 0:
+            sys.exit(1)
+        print("Exact DP, ZeroSumSubsetIndex and SettlementCache agree with brute force")
+
+    cases = []
+    for kind in ["random", "equal_magnitude", "planted_groups", "near_zero_trap"]:
+        for n in range(args.min_players, args.max_players + 1):
+            for seed in range(args.seeds):
+                case = run_case(kind, n, seed, args.repeats)
+                cases.append(case)
+                print(f'{kind:16} n={n:2} seed={seed} {case["seconds"] * 1000:9.2f}ms {case["transactions"]:3} transactions '
+                      f'(optimum {case["optimum"]}, greedy {case["greedy_transactions"]}) chosen_k={case["chosen_k"]}')
+
+    results = {
+        "python": sys.version.split()[0],
+        "exact_max_players": utilities.EXACT_SETTLEMENT_MAX_PLAYERS,
+        "heuristic_subset_budget": utilities.HEURISTIC_SUBSET_BUDGET,
+        "cases": cases,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {len(cases)} cases to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.time_tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+import os
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorClientSession
+from pymongo.server_api import ServerApi
+import pymongo.errors
+from pymongo import UpdateOne
+import asyncio
+import datetime
+import logging
+import migrations
+import utilities
+import metrics
+
+#--ASYNC MONGODB DATA ACCESS--#
+#Every call here awaits the motor (asyncio MongoDB) driver, so concurrent commands overlap their database latency
+#instead of blocking the discord.py event loop on each Atlas round-trip.
+
+load_dotenv()
+DB_USERNAME = os.getenv('DB_USERNAME')
+DB_PASSWORD = os.getenv('DB_PASSWORD')
+DB_CLUSTER_STRING = os.getenv('DB_CLUSTER_STRING')
+DB_MAX_POOL_SIZE = int(os.getenv('DB_MAX_POOL_SIZE', '50'))
+DB_MIN_POOL_SIZE = int(os.getenv('DB_MIN_POOL_SIZE', '5')) #kept warm so a burst of commands doesn't pay for new TLS handshakes
+DB_MAX_IDLE_TIME_MS = int(os.getenv('DB_MAX_IDLE_TIME_MS', '300000'))
+USERS_CACHE_SIZE = int(os.getenv('USERS_CACHE_SIZE', '4096'))
+USERS_CACHE_TTL = float(os.getenv('USERS_CACHE_TTL', '900')) #seconds, bounds how stale a Venmo username can be on replicas without the change stream
+USERS_CHANGE_STREAM = os.getenv('USERS_CHANGE_STREAM', '1' if os.getenv('SHARD_COUNT') else '0') == '1' #follow a change stream on users to invalidate the cache (needs a replica set, e.g. Atlas)
+OUTSTANDING_PAYMENTS_BATCH_SIZE = int(os.getenv('OUTSTANDING_PAYMENTS_BATCH_SIZE', '100')) #cursor batch size when reading a debtor's payments
+LEGACY_GUILD_ID = int(os.getenv('LEGACY_GUILD_ID')) if os.getenv('LEGACY_GUILD_ID') else None #guild that outstanding payments from before per-guild ledgers are moved into on startup
+
+log = logging.getLogger(__name__)
+
+DB_URL = os.getenv('DB_URL') #full connection string, overrides the Atlas credentials above (e.g. a local mongod for loadtest.py)
+DB_NAME = os.getenv('DB_NAME', 'discordBot')
+
+db_url = DB_URL if DB_URL else f'mongodb+srv://{DB_USERNAME}:{DB_PASSWORD}@{DB_CLUSTER_STRING}'
+
+#the client connects lazily in the background, creating it does no network I/O
+db_client = AsyncIOMotorClient(db_url, server_api=ServerApi('1'), maxPoolSize=DB_MAX_POOL_SIZE, minPoolSize=DB_MIN_POOL_SIZE,
+                               maxIdleTimeMS=DB_MAX_IDLE_TIME_MS, retryWrites=True)
+
+db = db_client[DB_NAME] #create a new database in cluster called "discordBot" (or DB_NAME) if does not exist
+users_collection = db.users #create a new "users" collection (table) in discordBot database if doesn't exist
+outstanding_payments_collection = db.outstanding_payments #create a new "outstanding_payments" collection (table) in discordBot database if doesn't exist, one ledger per guild_id
+games_collection = db.games #append-only archive of every recorded game's buy-ins and winnings
+player_stats_collection = db.player_stats #per guild and player aggregates kept up to date as games are recorded (net profit, games played, biggest win)
+
+#every outstanding_payments index is led by guild_id, so per-guild queries and compaction only ever scan their own guild
+OUTSTANDING_PAYMENTS_PAIR_INDEX = [("guild_id", 1), ("debtor", 1), ("recipient", 1)]
+#covering indexes for the payout queries, every field they match on or return
+DEBTOR_PAYMENTS_INDEX = [("guild_id", 1), ("debtor", 1), ("recipient", 1), ("amount_cents", 1)]
+RECIPIENT_PAYMENTS_INDEX = [("guild_id", 1), ("recipient", 1), ("debtor", 1), ("amount_cents", 1)]
+
+#users entries only change on /connect-venmo, so cache them in process (only existing entries are cached, so a new verification is never hidden)
+users_cache = utilities.LRUTTLCache(maxsize=USERS_CACHE_SIZE, ttl=USERS_CACHE_TTL)
+
+
+async def ping():
+    """Round-trip to the deployment, which also opens the first pooled connection. Raises if it can't be reached."""
+    await db_client.admin.command('ping')
+    log.info("Pinged your deployment. You successfully connected to MongoDB!")
+
+
+async def ensure_indexes():
+    """Create the indexes the collections rely on (no-ops when they already exist)."""
+    try:
+        dropped = await migrations.drop_unscoped_indexes(outstanding_payments_collection)
+        if len(dropped) > 0:
+            log.info(f"Dropped outstanding_payments indexes from before per-guild ledgers", extra={"indexes": dropped})
+        await outstanding_payments_collection.create_index(OUTSTANDING_PAYMENTS_PAIR_INDEX, name="guild_debtor_recipient", unique=True)
+    except pymongo.errors.PyMongoError as e:
+        log.error(f"An error occurred while creating the unique index in outstanding_payments_collection: {e}")
+
+    #cover the payout queries so they never fetch ledger documents: a debtor's edges and who owes a recipient
+    try:
+        await outstanding_payments_collection.create_indexes([
+            pymongo.IndexModel(DEBTOR_PAYMENTS_INDEX, name="guild_debtor_payments"),
+            pymongo.IndexModel(RECIPIENT_PAYMENTS_INDEX, name="guild_recipient_payments"),
+        ])
+    except pymongo.errors.PyMongoError as e:
+        log.error(f"An error occurred while creating the covering indexes in outstanding_payments_collection: {e}")
+
+    try:
+        await games_collection.create_index([("guild_id", 1), ("recorded_at", -1)], name="guild_games")
+        await player_stats_collection.create_indexes([
+            pymongo.IndexModel([("guild_id", 1), ("player", 1)], name="guild_player", unique=True),
+            pymongo.IndexModel([("guild_id", 1), ("net_cents", -1)], name="guild_leaderboard"),
+        ])
+    except pymongo.errors.PyMongoError as e:
+        log.error(f"An error occurred while creating the games and player_stats indexes: {e}")
+
+
+async def run_migrations():
+    """Bring stored documents up to the current format."""
+    #convert any outstanding_payments documents still stored in the old float dollar format to integer cents
+    try:
+        migrated = await migrations.migrate_outstanding_payments_to_cents(outstanding_payments_collection)
+        if migrated > 0:
+            log.info(f"Migrated {migrated} outstanding_payments entries to integer cents", extra={"migrated": migrated})
+    except pymongo.errors.PyMongoError as e:
+        log.error(f"An error occurred while migrating outstanding_payments_collection to integer cents: {e}")
+
+    #outstanding payments recorded before ledgers were scoped per guild are invisible until they are given a guild
+    try:
+        if LEGACY_GUILD_ID != None:
+            migrated = await migrations.assign_guild_to_outstanding_payments(outstanding_payments_collection, LEGACY_GUILD_ID)
+            if migrated > 0:
+                log.info(f"Moved {migrated} outstanding_payments entries into guild {LEGACY_GUILD_ID}", extra={"migrated": migrated})
+        unscoped = await migrations.count_unscoped_outstanding_payments(outstanding_payments_collection)
+        if unscoped > 0:
+            log.warning(f"{unscoped} outstanding_payments entries have no guild_id, set LEGACY_GUILD_ID or run migrations.py --guild-id", extra={"unscoped": unscoped})
+    except pymongo.errors.PyMongoError as e:
+        log.error(f"An error occurred while assigning guilds to outstanding_payments_collection: {e}")
+
+
+async def watch_users_changes():
+    """
+    Follow a change stream on the users collection and invalidate cached entries that change, so multiple bot
+    replicas stay coherent. Runs until cancelled, reconnecting after errors.
+    """
+    while True:
+        try:
+            async with users_collection.watch() as stream:
+                async for change in stream:
+                    if "documentKey" in change:
+                        users_cache.invalidate(change["documentKey"]["_id"])
+                    else: #drop/rename/invalidate events, can't tell which entries changed
+                        users_cache.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"Error in users change stream, restarting in 5 seconds: {e}")
+            users_cache.clear() #changes may have been missed while disconnected
+            await asyncio.sleep(5)
+
+
+async def start_session():
+    """Start an explicit session for a multi-document transaction, use as "async with await database.start_session() as session"."""
+    return await db_client.start_session()
+
+
+#--DATABASE OPERATION WRAPPERS--#
+
+#implements insert if non-existant entry or update if entry exists
+@metrics.timed_stage("mongo")
+async def create_users_entry(discord_id, username):
+    try:
+        user_entry = {"_id": discord_id, "venmo_usr": username}
+        await users_collection.insert_one(user_entry)
+        users_cache.set(discord_id, user_entry) #write through
+        return True
+    except pymongo.errors.DuplicateKeyError as e: #entry exists
+        log.debug(f"Duplicate key error in create_users_entry, updating entry instead")
+        await users_collection.update_one({"_id": discord_id}, {"$set": {"venmo_usr": username}})
+        users_cache.set(discord_id, user_entry) #write through
+        return True
+    except Exception as e:
+        users_cache.invalidate(discord_id) #unknown whether the write went through
+        log.error(f"Unknown error in create_users_entry: {e}")
+        return False
+
+
+@metrics.timed_stage("mongo")
+async def get_users_entry(discord_id):
+    cached = users_cache.get(discord_id)
+    if cached != None:
+        return cached
+
+    try:
+        result = await users_collection.find_one({"_id": discord_id})
+        if result != None:
+            users_cache.set(discord_id, result)
+        return result
+    except Exception as e:
+        log.error(f"Unknown error in get_users_entry: {e}")
+        return None
+
+
+#fetches all entries not in the cache in one $in query, returns a dict of discord id -> users entry (ids without an entry are left out) or None on error
+@metrics.timed_stage("mongo")
+async def get_users_entries(discord_ids):
+    result = {}
+    missing = []
+    for discord_id in discord_ids:
+        cached = users_cache.get(discord_id)
+        if cached != None:
+            result[discord_id] = cached
+        else:
+            missing.append(discord_id)
+
+    if len(missing) == 0: #every player resolved without network I/O
+        return result
+
+    try:
+        async for user_entry in users_collection.find({"_id": {"$in": missing}}):
+            result[user_entry["_id"]] = user_entry
+            users_cache.set(user_entry["_id"], user_entry)
+        return result
+    except Exception as e:
+        log.error(f"Unknown error in get_users_entries: {e}")
+        return None
+
+
+#implements insert if non-existant entry or update if entry exists for every [debtor, recipient, amount_cents] transaction of a game in guild_id,
+#sent as one ordered bulk_write in the given session, so recording a game is a single round-trip however many transactions it has
+#fields: guild the debt was made in, discord id of person who owes money, discord id of person to whom money is owed (can't be their venmo since it can change in users table), amount in integer cents
+@metrics.timed_stage("mongo")
+async def create_outstanding_payments_entries(guild_id: int, transactions, session: AsyncIOMotorClientSession):
+    if not (isinstance(guild_id, int) and isinstance(session, AsyncIOMotorClientSession)):
+        log.error("create_outstanding_payments_entries parameters are incorrect types")
+        raise TypeError("create_outstanding_payments_entries parameters are incorrect types")
+
+    operations = []
+    for discord_id_debtor, discord_id_recipient, amount_cents in transactions:
+        if not (isinstance(discord_id_debtor, int) and isinstance(discord_id_recipient, int) and isinstance(amount_cents, int)):
+            log.error("create_outstanding_payments_entries parameters are incorrect types")
+            raise TypeError("create_outstanding_payments_entries parameters are incorrect types")
+
+        #same filter as the {guild_id, debtor, recipient} unique index, so each pair still has exactly one entry per guild
+        operations.append(UpdateOne({"guild_id": guild_id, "debtor": discord_id_debtor, "recipient": discord_id_recipient}, {"$inc": {"amount_cents": amount_cents}}, upsert=True))
+
+    if len(operations) > 0:
+        await outstanding_payments_collection.bulk_write(operations, ordered=True, session=session)
+
+
+#reads every outstanding payment of the debtor in guild_id as {recipient, amount_cents, venmo_usr} in batches and deletes the ones that can be
+#paid with one delete_many in the same transaction
+#returns (paid entries, entries whose recipient has no Venmo username) or None on error
+@metrics.timed_stage("mongo")
+async def claim_outstanding_payments_entries(guild_id, discord_id, batch_size=OUTSTANDING_PAYMENTS_BATCH_SIZE):
+    try:
+        async with await start_session() as session:
+            async with session.start_transaction():
+                paid = []
+                missing = []
+                cursor = outstanding_payments_collection.aggregate([
+                    {'$match': {'guild_id': guild_id, 'debtor': discord_id}},
+                    {'$project': {'_id': 0, 'recipient': 1, 'amount_cents': 1}}, #only indexed fields, so the scan is covered
+                    {
+                        '$lookup':
+                        {
+                            "from": "users",
+                            "let": {"recipient": "$recipient"},
+                            "pipeline": [
+                                {'$match': {'$expr': {'$eq': ['$_id', '$$recipient']}}},
+                                {'$project': {'_id': 0, 'venmo_usr': 1}}
+                            ],
+                            "as": "results"
+                        }
+                    },
+                    {'$project': {'recipient': 1, 'amount_cents': 1, 'venmo_usr': {'$first': '$results.venmo_usr'}}}
+                ], session=session, batchSize=batch_size, hint="guild_debtor_payments")
+
+                async for entry in cursor:
+                    if entry.get("venmo_usr") == None:
+                        missing.append(entry)
+                    else:
+                        paid.append(entry)
+
+                if len(paid) > 0:
+                    #(guild_id, debtor, recipient) is unique, so this deletes exactly the paid entries through the same index
+                    await outstanding_payments_collection.delete_many({"guild_id": guild_id, "debtor": discord_id, "recipient": {"$in": [entry["recipient"] for entry in paid]}}, session=session)
+
+                return paid, missing
+    except Exception as e:
+        log.error(f"Unknown error in claim_outstanding_payments_entries: {e}")
+        return None
+
+
+#returns every outstanding payment owed to the recipient in guild_id as a list of {debtor, amount_cents} (largest first), or None on error
+@metrics.timed_stage("mongo")
+async def get_incoming_payments_entries(guild_id, discord_id):
+    try:
+        cursor = outstanding_payments_collection.find({"guild_id": guild_id, "recipient": discord_id}, {"_id": 0, "debtor": 1, "amount_cents": 1},
+                                                      hint="guild_recipient_payments", batch_size=OUTSTANDING_PAYMENTS_BATCH_SIZE)
+        return sorted(await cursor.to_list(length=None), key=lambda entry: entry["amount_cents"], reverse=True)
+    except Exception as e:
+        log.error(f"Unknown error in get_incoming_payments_entries: {e}")
+        return None
+
+
+#returns every outstanding payments entry of guild_id as a list (read inside the session's transaction if one is given)
+@metrics.timed_stage("mongo")
+async def get_all_outstanding_payments_entries(guild_id, session: AsyncIOMotorClientSession = None):
+    return await outstanding_payments_collection.find({"guild_id": guild_id}, {"debtor": 1, "recipient": 1, "amount_cents": 1}, session=session).to_list(length=None)
+
+
+#returns every outstanding payments entry of guild_id where one of the players is the debtor or the recipient (read inside the session's transaction if one is given)
+@metrics.timed_stage("mongo")
+async def get_outstanding_payments_entries_for_players(guild_id, discord_ids, session: AsyncIOMotorClientSession = None):
+    discord_ids = list(discord_ids)
+    return await outstanding_payments_collection.find({"guild_id": guild_id, "$or": [{"debtor": {"$in": discord_ids}}, {"recipient": {"$in": discord_ids}}]},
+                                                      {"debtor": 1, "recipient": 1, "amount_cents": 1}, session=session).to_list(length=None)
+
+
+#replaces the entries with the given _ids by new [debtor, recipient, amount_cents] transactions in guild_id, must pass in the session for ACID transaction (all or nothing)
+@metrics.timed_stage("mongo")
+async def replace_outstanding_payments_entries(guild_id, entry_ids, transactions, session: AsyncIOMotorClientSession):
+    if not isinstance(session, AsyncIOMotorClientSession):
+        log.error("replace_outstanding_payments_entries parameters are incorrect types")
+        raise TypeError("replace_outstanding_payments_entries parameters are incorrect types")
+
+    await outstanding_payments_collection.delete_many({"guild_id": guild_id, "_id": {"$in": list(entry_ids)}}, session=session)
+    if len(transactions) > 0:
+        await create_outstanding_payments_entries(guild_id, transactions, session)
+
+
+#appends the game's [player_id, buy_in_cents, winnings_cents] rows to the games archive and folds them into each player's stats
+#with $inc/$max upserts, must pass in the session so it commits together with the game's outstanding payments
+#game_id (optional) becomes the game's _id, so writing the same game twice raises DuplicateKeyError and aborts the transaction
+#returns the archived game's _id
+@metrics.timed_stage("mongo")
+async def archive_game(guild_id: int, game_data, recorded_by: int, session: AsyncIOMotorClientSession, game_id=None, recorded_at=None):
+    if not (isinstance(guild_id, int) and isinstance(session, AsyncIOMotorClientSession)):
+        log.error("archive_game parameters are incorrect types")
+        raise TypeError("archive_game parameters are incorrect types")
+
+    now = recorded_at if recorded_at != None else datetime.datetime.now(datetime.timezone.utc)
+    game_entry = {
+        "guild_id": guild_id,
+        "recorded_by": recorded_by,
+        "recorded_at": now,
+        "players": [{"player": player_id, "buy_in_cents": buy_in_cents, "winnings_cents": winnings_cents} for player_id, buy_in_cents, winnings_cents in game_data],
+    }
+    if game_id != None:
+        game_entry["_id"] = game_id
+    result = await games_collection.insert_one(game_entry, session=session)
+
+    operations = []
+    for player_id, buy_in_cents, winnings_cents in game_data:
+        profit_cents = winnings_cents - buy_in_cents
+        operations.append(UpdateOne({"guild_id": guild_id, "player": player_id},
+                                    {"$inc": {"games_played": 1, "net_cents": profit_cents, "buy_in_cents": buy_in_cents},
+                                     "$max": {"biggest_win_cents": profit_cents, "last_played": now}},
+                                    upsert=True))
+    if len(operations) > 0:
+        await player_stats_collection.bulk_write(operations, ordered=False, session=session)
+
+    return result.inserted_id
+
+
+#returns whether a game with this _id is in the games archive (None on error)
+@metrics.timed_stage("mongo")
+async def game_exists(game_id):
+    try:
+        return await games_collection.find_one({"_id": game_id}, {"_id": 1}) != None
+    except Exception as e:
+        log.error(f"Unknown error in game_exists: {e}")
+        return None
+
+
+#returns the player's stats document in guild_id, None if they haven't played a recorded game there, or False on error
+@metrics.timed_stage("mongo")
+async def get_player_stats(guild_id, discord_id):
+    try:
+        return await player_stats_collection.find_one({"guild_id": guild_id, "player": discord_id}, {"_id": 0})
+    except Exception as e:
+        log.error(f"Unknown error in get_player_stats: {e}")
+        return False
+
+
+#returns the top limit players of guild_id by net profit as a list of stats documents, or None on error
+@metrics.timed_stage("mongo")
+async def get_leaderboard(guild_id, limit=10):
+    try:
+        cursor = player_stats_collection.find({"guild_id": guild_id}, {"_id": 0}, hint="guild_leaderboard").sort("net_cents", -1).limit(limit)
+        return await cursor.to_list(length=limit)
+    except Exception as e:
+        log.error(f"Unknown error in get_leaderboard: {e}")
+        return None
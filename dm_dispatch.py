@@ -0,0 +1,76 @@
+import os
+import asyncio
+import discord
+import utilities
+
+#--DM DISPATCH--#
+#Sends a batch of DMs concurrently. discord.py's HTTP client already queues every request on its per-route rate-limit
+#bucket (and retries 429s), so we only bound how many sends are in flight at once with a semaphore.
+#Whether a user accepts DMs is learned from the outcome of real sends, so we never probe with an extra request. A refused DM
+#(DMs closed or bot blocked) is remembered for DM_REFUSED_TTL seconds so one payout doesn't retry the same user, any other
+#outcome clears it, and once it expires the next real send finds out whether they reopened their DMs.
+
+DM_MAX_CONCURRENCY = int(os.getenv('DM_MAX_CONCURRENCY', '5'))
+DM_REFUSED_CACHE_SIZE = int(os.getenv('DM_REFUSED_CACHE_SIZE', '4096'))
+DM_REFUSED_TTL = float(os.getenv('DM_REFUSED_TTL', '300')) #seconds a refused DM skips further sends to that user
+
+#discord id -> True for users who refused a DM in the last DM_REFUSED_TTL seconds
+dm_refused_cache = utilities.LRUTTLCache(maxsize=DM_REFUSED_CACHE_SIZE, ttl=DM_REFUSED_TTL)
+
+
+def record_dm_outcome(user_id, error):
+    """Update the refused cache from a real send."""
+    if isinstance(error, discord.Forbidden):
+        dm_refused_cache.set(user_id, True)
+    else:
+        dm_refused_cache.invalidate(user_id)
+
+
+async def send_dm(user: discord.abc.User, **kwargs):
+    """
+    Send one DM (kwargs are passed to user.send) and record whether it went through.
+    Return value: (True, None) on success, (False, exception) if the user can't be DMed or the send failed
+    """
+    if user == None:
+        return False, ValueError("Unknown user")
+
+    try:
+        await user.send(**kwargs) #creates the DM channel if needed
+        error = None
+    except discord.HTTPException as e: #includes discord.Forbidden (DMs closed or user blocked the bot)
+        error = e
+
+    record_dm_outcome(user.id, error)
+    return error == None, error
+
+
+async def dispatch_dms(messages, max_concurrency=DM_MAX_CONCURRENCY):
+    """
+    Send every (user, embed) in messages as a DM concurrently, at most max_concurrency in flight.
+    Users who refused a DM in the last DM_REFUSED_TTL seconds are skipped without a request.
+    Return value: list in the same order as messages of dicts {"user", "embed", "success", "error"}
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def send(user, embed):
+        if user == None:
+            return {"user": user, "embed": embed, "success": False, "error": ValueError("Unknown user")}
+        if user.id in dm_refused_cache:
+            return {"user": user, "embed": embed, "success": False, "error": discord.ClientException("User recently refused DMs (cached)")}
+
+        async with semaphore:
+            try:
+                await user.send(embed=embed) #creates the DM channel if needed
+                error = None
+            except discord.HTTPException as e: #includes discord.Forbidden (DMs closed or user blocked the bot)
+                error = e
+
+        record_dm_outcome(user.id, error)
+        return {"user": user, "embed": embed, "success": error == None, "error": error}
+
+    return await asyncio.gather(*[send(user, embed) for user, embed in messages])
+
+
+def chunk_embeds(items, size=10):
+    """Split items into lists of at most size, discord allows up to 10 embeds per message."""
+    return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,119 @@
+from collections import defaultdict
+import logging
+import pymongo.errors
+import database
+import metrics
+import utilities
+
+log = logging.getLogger(__name__)
+
+#--LEDGER COMPACTION--#
+#outstanding_payments only merges amounts for the same (debtor, recipient) pair, so after many games it fills up with
+#A->B / B->A pairs and chains (A->B->C) that could be netted. Compaction turns a guild's ledger back into per-player net
+#balances, re-runs the settlement algorithm on them and rewrites the (minimal) edge set in one transaction. Every guild has
+#its own ledger, so the work is bounded by the busiest guild and not by how many guilds the bot is in.
+
+
+def get_net_balances(entries):
+    """Net balance in cents of every player in the given outstanding payments entries (positive owes, negative is owed)."""
+    balances = defaultdict(int)
+    for entry in entries:
+        balances[entry["debtor"]] += entry["amount_cents"]
+        balances[entry["recipient"]] -= entry["amount_cents"]
+    return balances
+
+
+def get_entries_snapshot(entries):
+    return sorted((str(entry["_id"]), entry["amount_cents"]) for entry in entries)
+
+
+async def compact_ledger(guild_id, settle):
+    """
+    Net guild_id's whole outstanding_payments ledger and rewrite it with the fewest edges the settlement algorithm finds.
+    settle is an async callable taking game_data rows [player_id, buy_in_cents, winnings_cents] (e.g. SettlementExecutor.settle),
+    so the search runs outside the event loop and outside the database transaction. The rewrite is optimistic: if the
+    ledger changed while settling (another game was recorded or paid) nothing is written and None is returned.
+    Return value: number of edges removed (0 if the ledger was already minimal), or None if the ledger changed
+    """
+    entries = await database.get_all_outstanding_payments_entries(guild_id)
+    if len(entries) <= 1:
+        return 0
+
+    #a net debt is the same as a buy-in with no winnings (and a net credit a negative buy-in)
+    game_data = [[player_id, balance, 0] for player_id, balance in get_net_balances(entries).items() if balance != 0]
+    transactions = await settle(game_data)
+
+    if transactions == None: #ledger doesn't sum to zero, should never happen
+        log.error("Ledger compaction error: outstanding payments do not net to zero", extra={"guild_id": guild_id})
+        return 0
+
+    if len(transactions) >= len(entries):
+        return 0
+
+    snapshot = get_entries_snapshot(entries)
+    async with metrics.stage("mongo"): #also counts starting the session and the commit round-trip
+        async with await database.start_session() as session:
+            async with session.start_transaction():
+                #re-read inside the transaction, only rewrite if nothing changed since we settled
+                if get_entries_snapshot(await database.get_all_outstanding_payments_entries(guild_id, session)) != snapshot:
+                    return None
+
+                await database.replace_outstanding_payments_entries(guild_id, [entry["_id"] for entry in entries], transactions, session)
+
+    removed = len(entries) - len(transactions)
+    log.info(f"Ledger compaction removed {removed} outstanding payments edges", extra={"guild_id": guild_id, "removed": removed, "edges_before": len(entries), "edges_after": len(transactions)})
+    return removed
+
+
+#--INCREMENTAL SETTLEMENT--#
+#Instead of appending a game's own settlement to the ledger, fold it into the existing edges of the players it touches:
+#take every edge with one of the game's players on either side, add the game's debts to the balances those edges imply
+#and re-settle just that sub-ledger from scratch. Edges between players the game doesn't touch (and so their zero-sum groupings)
+#are left as they are, so the work is proportional to the game's players and their edges, not the size of the ledger.
+#Balances are derived from those edges rather than stored, the edges are the only copy of the ledger.
+
+
+async def fold_game_into_ledger(guild_id, game_data, settle, recorded_by, max_attempts=3, game_id=None, recorded_at=None):
+    """
+    Record a game played in guild_id (rows [player_id, buy_in_cents, winnings_cents], must sum to zero) by re-settling it together with its
+    players' outstanding edges, and archive it in the same transaction.
+    Optimistic like compact_ledger: if the touched edges change while settling it retries, and after max_attempts it
+    falls back to appending the game's own settlement. game_id and recorded_at are passed on to database.archive_game.
+    Return value: (number of edges replaced, number of edges written)
+    """
+    debts = utilities.get_player_debts(game_data)
+    player_ids = [row[0] for row in game_data]
+
+    for attempt in range(max_attempts):
+        entries = await database.get_outstanding_payments_entries_for_players(guild_id, player_ids)
+        balances = get_net_balances(entries)
+        for player_id, debt in debts:
+            balances[player_id] += debt
+
+        transactions = await settle([[player_id, balance, 0] for player_id, balance in balances.items() if balance != 0])
+        snapshot = get_entries_snapshot(entries)
+
+        try:
+            async with metrics.stage("mongo"):
+                async with await database.start_session() as session:
+                    async with session.start_transaction():
+                        if get_entries_snapshot(await database.get_outstanding_payments_entries_for_players(guild_id, player_ids, session)) == snapshot:
+                            await database.replace_outstanding_payments_entries(guild_id, [entry["_id"] for entry in entries], transactions, session)
+                            await database.archive_game(guild_id, game_data, recorded_by, session, game_id, recorded_at)
+                            return len(entries), len(transactions)
+
+        except pymongo.errors.PyMongoError as e:
+            if not e.has_error_label("TransientTransactionError"): #write conflict with a concurrent game, safe to retry
+                raise
+
+        log.info(f"Outstanding payments changed while folding a game in, retrying", extra={"attempt": attempt + 1})
+
+    #the touched edges kept changing, just append the game's own settlement
+    transactions = await settle(game_data)
+    async with metrics.stage("mongo"):
+        async with await database.start_session() as session:
+            async with session.start_transaction():
+                await database.create_outstanding_payments_entries(guild_id, transactions, session)
+                await database.archive_game(guild_id, game_data, recorded_by, session, game_id, recorded_at)
+
+    return 0, len(transactions)
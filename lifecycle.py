@@ -0,0 +1,83 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+import discord
+import database
+import metrics
+
+#--STARTUP LIFECYCLE--#
+#The gateway connects first and the database is warmed up in the background: ping (opens the pool, motor keeps
+#DB_MIN_POOL_SIZE connections warm from then on), indexes, then format migrations. Only commands that touch the database
+#wait for it, and only for up to DB_READY_WAIT seconds so they still answer inside discord's 3 second interaction deadline.
+
+DB_READY_WAIT = float(os.getenv('DB_READY_WAIT', '2.0'))
+DB_CONNECT_RETRY_MAX = float(os.getenv('DB_CONNECT_RETRY_MAX', '30')) #seconds, cap on the backoff between failed pings
+
+log = logging.getLogger(__name__)
+
+process_start = time.perf_counter()
+db_ready = asyncio.Event() #set once the database is reachable and its indexes and migrations have run
+startup_phases = {} #phase name -> seconds from process start until it finished
+
+
+def record_phase(name):
+    """Record that startup phase name just finished. Later calls for the same phase are ignored (on_ready fires on every reconnect)."""
+    if name in startup_phases:
+        return
+    elapsed = time.perf_counter() - process_start
+    startup_phases[name] = elapsed
+    metrics.startup_phase_seconds.set(round(elapsed, 4), name)
+    log.info(f"startup phase {name} finished", extra={"phase": name, "seconds": round(elapsed, 4)})
+
+
+async def warm_up_database(on_ready=None):
+    """
+    Connect to the database (retrying with backoff until it answers), create indexes, run migrations and set db_ready.
+    on_ready is an optional async callable run afterwards, for background work that needs the database.
+    """
+    delay = 1
+    while True:
+        try:
+            await database.ping()
+            break
+        except Exception as e:
+            log.error(f"Error pinging MongoDB deployment, retrying in {delay} seconds: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, DB_CONNECT_RETRY_MAX)
+    record_phase("db_connected")
+
+    await database.ensure_indexes()
+    record_phase("db_indexes")
+
+    await database.run_migrations()
+    record_phase("db_migrations")
+
+    db_ready.set()
+    record_phase("db_ready")
+
+    if on_ready != None:
+        await on_ready()
+
+
+def requires_database(function):
+    """
+    Decorator for slash command callbacks (and modal submits) that use the database. While the database is still warming
+    up it waits up to DB_READY_WAIT seconds, then answers with a "starting up" message instead of running the command.
+    """
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        if not db_ready.is_set():
+            try:
+                await asyncio.wait_for(db_ready.wait(), timeout=DB_READY_WAIT)
+            except asyncio.TimeoutError:
+                interaction = next(arg for arg in args if isinstance(arg, discord.Interaction))
+                embed = discord.Embed(title= f'❌ Bot Starting Up', description= f'The bot is still connecting to its database. Please try again in a few seconds.', color=0xf50000)
+                if interaction.response.is_done():
+                    await interaction.followup.send(embed=embed)
+                else:
+                    await interaction.response.send_message(embed=embed)
+                return
+        return await function(*args, **kwargs)
+    return wrapper
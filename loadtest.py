@@ -0,0 +1,265 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+
+#must be set before database is imported: a local scratch database and no metrics endpoint unless asked otherwise
+os.environ.setdefault('DB_URL', 'mongodb://localhost:27017/?replicaSet=rs0')
+os.environ.setdefault('DB_NAME', 'discordBot_loadtest')
+os.environ.setdefault('METRICS_PORT', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+import discord
+import database
+import lifecycle
+import metrics
+import pokerBot
+
+#--LOAD TEST--#
+#Fires hundreds of concurrent slash command invocations at the real command callbacks, with fake discord objects
+#(interaction, response, followup, DMs, each sleeping a simulated API latency) and a local mongod in place of Atlas,
+#and reports throughput, p50/p99 latency per command, the time spent in each stage and event loop lag.
+#Transactions need a replica set, start a single node one with:
+#    mongod --replSet rs0 --dbpath /tmp/loadtest-db    and once:    mongosh --eval "rs.initiate()"
+#Usage: python loadtest.py [--invocations 500] [--concurrency 100] [--players 200] [--discord-latency 0.05] [--output results.json]
+#DB_URL / DB_NAME override the database (the scratch DB_NAME is dropped afterwards unless --keep-data).
+
+COMMANDS = {
+    "record-game": pokerBot.record_game_cmd,
+    "get-game-payments": pokerBot.immediate_payout_game_cmd,
+    "make-payments": pokerBot.payout_cmd,
+}
+
+
+class FakeHTTPResponse:
+    """Just enough of an aiohttp response for discord.HTTPException."""
+
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+
+async def fake_discord_call(latency):
+    """A discord REST request: counted as the discord stage like the real (instrumented) HTTP client and interaction webhook adapter."""
+    with metrics.stage("discord"):
+        await asyncio.sleep(latency)
+
+
+class FakeUser:
+    def __init__(self, user_id, name, latency, accepts_dms=True):
+        self.id = user_id
+        self.name = name
+        self.latency = latency
+        self.acceptsDms = accepts_dms
+        self.dms = []
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+    async def send(self, content=None, **kwargs):
+        await fake_discord_call(self.latency)
+        if not self.acceptsDms:
+            raise discord.Forbidden(FakeHTTPResponse(403, "Forbidden"), "Cannot send messages to this user")
+        self.dms.append(kwargs.get("embed"))
+
+
+class FakeMessage:
+    def __init__(self, latency):
+        self.latency = latency
+
+    async def edit(self, **kwargs):
+        await fake_discord_call(self.latency)
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def respond(self, kwargs):
+        if self.done:
+            raise discord.InteractionResponded(self.interaction)
+        self.done = True
+        await fake_discord_call(self.interaction.latency)
+        self.interaction.messages.append(kwargs)
+
+    async def send_message(self, content=None, **kwargs):
+        await self.respond(dict(kwargs, content=content))
+
+    async def defer(self, **kwargs):
+        await self.respond({})
+
+    async def edit_message(self, **kwargs):
+        await self.respond(kwargs)
+
+    async def send_modal(self, modal):
+        await self.respond({"modal": modal})
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        await fake_discord_call(self.interaction.latency)
+        self.interaction.messages.append(dict(kwargs, content=content))
+        return FakeMessage(self.interaction.latency)
+
+
+class FakeInteraction:
+    """The parts of discord.Interaction the commands use. Every message sent is kept in messages."""
+
+    def __init__(self, user, guild_id, latency):
+        self.user = user
+        self.guild_id = guild_id
+        self.latency = latency
+        self.messages = []
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.channel = self.followup
+
+    async def original_response(self):
+        await fake_discord_call(self.latency)
+        return FakeMessage(self.latency)
+
+
+def random_game(rng, players):
+    """Command kwargs for a 2 to 8 player game in dollars: buy-ins in $5 steps, winnings redistributed in quarters."""
+    seated = rng.sample(players, rng.randint(2, 8))
+    buy_ins = [rng.randint(1, 10) * 5 for player in seated]
+    quarters = [0] * len(seated)
+    for i in range(sum(buy_ins) * 4):
+        quarters[rng.randrange(len(seated))] += 1
+
+    kwargs = {}
+    for i, player in enumerate(seated):
+        kwargs[f"player{i + 1}"] = player
+        kwargs[f"player{i + 1}_buy_in"] = float(buy_ins[i])
+        kwargs[f"player{i + 1}_winnings"] = quarters[i] / 4
+    return kwargs
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+async def sample_event_loop_lag(samples, interval=0.01):
+    """Like metrics.monitor_event_loop_lag but keeps every sample, finer grained for short runs."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+
+async def run_load(args):
+    rng = random.Random(args.seed)
+    players = [FakeUser(10_000 + i, f"player{i}", args.discord_latency, accepts_dms=rng.random() >= args.closed_dms)
+               for i in range(args.players)]
+    users = {player.id: player for player in players}
+    pokerBot.bot.get_user = users.get #the commands look DM targets up in the gateway cache, which a load test doesn't have
+
+    await lifecycle.warm_up_database()
+    await asyncio.gather(*[database.create_users_entry(player.id, f"venmo-{player.name}") for player in players])
+    pokerBot.settlement_executor.start()
+
+    weights = [float(weight) for weight in args.mix.split(",")]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def invoke(name):
+        invoker = rng.choice(players)
+        kwargs = random_game(rng, players) if name != "make-payments" else {}
+        interaction = FakeInteraction(invoker, args.guild_id, args.discord_latency)
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await COMMANDS[name].callback(interaction, **kwargs)
+                status = "ok" if interaction.response.is_done() else "no_response"
+            except Exception as e:
+                status = f"error: {type(e).__name__}: {e}"
+            results.append({"command": name, "seconds": time.perf_counter() - start, "status": status})
+
+    lag_samples = []
+    lag_task = asyncio.create_task(sample_event_loop_lag(lag_samples))
+    start = time.perf_counter()
+    await asyncio.gather(*[invoke(name) for name in rng.choices(list(COMMANDS), weights=weights, k=args.invocations)])
+    elapsed = time.perf_counter() - start
+    lag_task.cancel()
+
+    if not args.keep_data:
+        await database.db_client.drop_database(database.DB_NAME)
+    pokerBot.settlement_executor.shutdown()
+
+    return results, elapsed, lag_samples
+
+
+def summarize(results, elapsed, lag_samples):
+    summary = {"invocations": len(results), "seconds": elapsed, "throughput": len(results) / elapsed, "commands": {}}
+    for name in COMMANDS:
+        latencies = [result["seconds"] for result in results if result["command"] == name]
+        failures = [result["status"] for result in results if result["command"] == name and result["status"] != "ok"]
+        stages = {}
+        for stage_name in metrics.STAGES:
+            series = metrics.command_stage_seconds.series.get((name, stage_name))
+            stages[stage_name] = series[-1] / series[-2] if series != None and series[-2] > 0 else 0.0 #mean seconds per invocation
+        summary["commands"][name] = {
+            "count": len(latencies),
+            "failures": len(failures),
+            "first_failure": failures[0] if len(failures) > 0 else None,
+            "p50": percentile(latencies, 0.50),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies) if len(latencies) > 0 else 0.0,
+            "mean_stage_seconds": stages,
+        }
+    summary["event_loop_lag"] = {"p50": percentile(lag_samples, 0.50), "p99": percentile(lag_samples, 0.99), "max": max(lag_samples, default=0.0)}
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the slash commands against a local mongod with fake discord objects")
+    parser.add_argument("--invocations", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100, help="invocations in flight at once")
+    parser.add_argument("--players", type=int, default=200, help="size of the fake member pool")
+    parser.add_argument("--mix", default="6,2,2", help="relative weights of record-game, get-game-payments and make-payments")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="seconds every fake discord request takes")
+    parser.add_argument("--closed-dms", type=float, default=0.1, help="fraction of players that refuse DMs")
+    parser.add_argument("--guild-id", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-data", action="store_true", help="don't drop the scratch database afterwards")
+    parser.add_argument("--output", help="also write the summary as JSON")
+    args = parser.parse_args()
+
+    if not args.keep_data and database.DB_NAME == "discordBot":
+        print("Refusing to drop the production database, set DB_NAME to a scratch database or pass --keep-data")
+        sys.exit(1)
+
+    summary = summarize(*asyncio.run(run_load(args)))
+
+    print(f'{summary["invocations"]} invocations in {summary["seconds"]:.2f}s ({summary["throughput"]:.1f}/s)')
+    for name, command in summary["commands"].items():
+        stages = " ".join(f'{stage_name}={seconds * 1000:.1f}ms' for stage_name, seconds in command["mean_stage_seconds"].items())
+        print(f'{name:18} n={command["count"]:4} failures={command["failures"]:3} p50={command["p50"] * 1000:8.1f}ms '
+              f'p99={command["p99"] * 1000:8.1f}ms max={command["max"] * 1000:8.1f}ms  mean {stages}')
+        if command["first_failure"] != None:
+            print(f'{"":18} first failure: {command["first_failure"]}')
+    lag = summary["event_loop_lag"]
+    print(f'event loop lag p50={lag["p50"] * 1000:.1f}ms p99={lag["p99"] * 1000:.1f}ms max={lag["max"] * 1000:.1f}ms')
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import os
+import time
+import json
+import asyncio
+import logging
+import functools
+import contextvars
+from collections import defaultdict
+from aiohttp import web
+from discord.webhook.async_ import async_context
+
+#--METRICS AND STRUCTURED LOGGING--#
+#Per-command latency histograms split into the time spent in Mongo, in settlement and in Discord HTTP, event loop lag and
+#gauges like the settlement executor's queue depth, served as Prometheus text on a local endpoint (METRICS_PORT, 0 disables).
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+#seconds, spans the 3 second interaction deadline
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0)
+STAGES = ("mongo", "settlement", "discord")
+
+log = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Cumulative bucket histogram with one series per label set, rendered in the Prometheus text format."""
+
+    def __init__(self, name, description, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelNames = label_names
+        self.buckets = buckets
+        self.series = {} #label values tuple -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series == None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for label_values, series in self.series.items():
+            labels = [f'{name}="{value}"' for name, value in zip(self.labelNames, label_values)]
+            for bound, count in zip(list(self.buckets) + ["+Inf"], series):
+                bucket_labels = ",".join(labels + ['le="%s"' % bound])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {count}")
+            label_string = "{" + ",".join(labels) + "}" if labels else ""
+            lines.append(f"{self.name}_count{label_string} {series[-2]}")
+            lines.append(f"{self.name}_sum{label_string} {series[-1]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.labelNames = label_names
+        self.values = defaultdict(float)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.values.items():
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labelNames, label_values))
+            lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return lines
+
+
+class Gauge:
+    """Last set value per label set."""
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.labelNames = label_names
+        self.values = {}
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for label_values, value in self.values.items():
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labelNames, label_values))
+            lines.append(f"{self.name}{{{labels}}} {value}" if labels else f"{self.name} {value}")
+        return lines
+
+
+command_seconds = Histogram("pokerbot_command_seconds", "Slash command latency", ("command", "status"))
+command_stage_seconds = Histogram("pokerbot_command_stage_seconds", "Time a slash command spent in each stage", ("command", "stage"))
+stage_seconds = Histogram("pokerbot_stage_seconds", "Time spent in each stage, inside or outside commands", ("stage",))
+event_loop_lag_seconds = Histogram("pokerbot_event_loop_lag_seconds", "How late the event loop ran a timer",
+                                   (), buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+commands_total = Counter("pokerbot_commands_total", "Slash commands handled", ("command", "status"))
+startup_phase_seconds = Gauge("pokerbot_startup_phase_seconds", "Seconds from process start until each startup phase finished", ("phase",))
+
+histograms = [command_seconds, command_stage_seconds, stage_seconds, event_loop_lag_seconds]
+counters = [commands_total]
+labelled_gauges = [startup_phase_seconds]
+gauges = {} #name -> (description, callable returning the current value), read when the endpoint is scraped
+
+#stage name -> seconds for the command running in the current task (None outside commands)
+current_command_stages = contextvars.ContextVar("current_command_stages", default=None)
+active_stage = contextvars.ContextVar("active_stage", default=None)
+
+
+def register_gauge(name, description, read):
+    gauges[name] = (description, read)
+
+
+class stage:
+    """Time a block as one of STAGES, e.g. "async with metrics.stage('mongo'):" (also usable as a plain "with")."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.nested = active_stage.get() == self.name #a wrapper calling another wrapper of the same stage is only counted once
+        if not self.nested:
+            self.token = active_stage.set(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.nested:
+            return False
+
+        elapsed = time.perf_counter() - self.start
+        active_stage.reset(self.token)
+        stage_seconds.observe(elapsed, self.name)
+        stages = current_command_stages.get()
+        if stages != None:
+            stages[self.name] += elapsed
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        return self.__exit__(*exc_info)
+
+
+def timed_stage(name):
+    """Decorator that times every call of an async function as stage name."""
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with stage(name):
+                return await function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed_command(name):
+    """
+    Decorator for slash command callbacks: records total latency and the time spent in each stage while it runs.
+    Put it directly above the def (below @app_commands.describe etc.), functools.wraps keeps the signature discord.py reads.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            stages = defaultdict(float)
+            token = current_command_stages.set(stages)
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                current_command_stages.reset(token)
+                command_seconds.observe(elapsed, name, status)
+                commands_total.inc(name, status)
+                for stage_name in STAGES:
+                    command_stage_seconds.observe(stages[stage_name], name, stage_name)
+                log.info("command finished", extra={"command": name, "status": status, "seconds": round(elapsed, 4),
+                                                    **{f"{stage_name}_seconds": round(stages[stage_name], 4) for stage_name in STAGES}})
+        return wrapper
+    return decorator
+
+
+def instrument_discord_http(http_client):
+    """
+    Time every Discord REST request as the "discord" stage: the bot's HTTP client (channel messages, DMs) and the webhook
+    adapter that interaction responses, defers, followups and original_response go through instead.
+    """
+    http_client.request = timed_stage("discord")(http_client.request)
+    adapter = async_context.get() #the default adapter every discord.Interaction uses
+    adapter.request = timed_stage("discord")(adapter.request)
+
+
+async def monitor_event_loop_lag(interval=0.5):
+    """Sleep for interval over and over and record how much later than asked the loop woke us up. Runs until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        event_loop_lag_seconds.observe(lag)
+        if lag > 1.0:
+            log.warning("event loop lag", extra={"lag_seconds": round(lag, 3)})
+
+
+def render():
+    lines = []
+    for metric in histograms + counters + labelled_gauges:
+        lines.extend(metric.render())
+    for name, (description, read) in gauges.items():
+        lines.extend([f"# HELP {name} {description}", f"# TYPE {name} gauge", f"{name} {read()}"])
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve render() at http://host:port/metrics. Return value: the aiohttp runner (call cleanup() to stop), or None if disabled"""
+    if port == 0:
+        return None
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info("metrics endpoint started", extra={"url": f"http://{host}:{port}/metrics"})
+    return runner
+
+
+#--STRUCTURED LOGGING--#
+
+#attributes every LogRecord has, anything else on a record came from extra={...}
+STANDARD_RECORD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, any extra={...} fields and the exception if there is one."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level=LOG_LEVEL):
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonLogFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
@@ -0,0 +1,108 @@
+import sys
+import asyncio
+import argparse
+import pymongo.errors
+
+#--STORED FORMAT MIGRATIONS--#
+#Each migration is idempotent (only touches documents still in the old format) so it is safe to run on every startup.
+#Run standalone with "python migrations.py" to migrate a database without starting the bot, add "--guild-id <id>" to move
+#outstanding payments recorded before the ledger was scoped per guild into that guild.
+
+#indexes from before the ledger was scoped per guild, they would stop the same two players owing each other in two guilds
+UNSCOPED_OUTSTANDING_PAYMENTS_INDEXES = ["debtor_1_recipient_1", "debtor_payments", "recipient_payments"]
+
+
+async def migrate_outstanding_payments_to_cents(outstanding_payments_collection):
+    """
+    Convert outstanding_payments documents from the old float dollar "amount" field to an integer "amount_cents" field.
+    Runs as a single server side pipeline update. If a document somehow has both fields (an old entry that was $inc'ed
+    by the new code before migrating), the amounts are added together.
+    Return value: number of migrated documents
+    """
+    result = await outstanding_payments_collection.update_many(
+        {"amount": {"$exists": True}},
+        [
+            {
+                "$set": {
+                    "amount_cents": {
+                        "$add": [
+                            {"$ifNull": ["$amount_cents", 0]},
+                            {"$toLong": {"$round": [{"$multiply": ["$amount", 100]}, 0]}}
+                        ]
+                    }
+                }
+            },
+            {"$unset": "amount"}
+        ]
+    )
+
+    return result.modified_count
+
+
+async def drop_unscoped_indexes(outstanding_payments_collection):
+    """Drop the outstanding_payments indexes that aren't led by guild_id. Return value: names of the dropped indexes"""
+    dropped = []
+    existing = await outstanding_payments_collection.index_information()
+    for name in UNSCOPED_OUTSTANDING_PAYMENTS_INDEXES:
+        if name in existing:
+            await outstanding_payments_collection.drop_index(name)
+            dropped.append(name)
+    return dropped
+
+
+async def count_unscoped_outstanding_payments(outstanding_payments_collection):
+    """Number of outstanding_payments documents that have no guild_id yet (invisible to every guild until migrated)."""
+    return await outstanding_payments_collection.count_documents({"guild_id": {"$exists": False}})
+
+
+async def assign_guild_to_outstanding_payments(outstanding_payments_collection, guild_id):
+    """
+    Move outstanding_payments documents without a guild_id into guild_id. A pair that already has an entry in that guild
+    (recorded after the upgrade) is merged into it, so the {guild_id, debtor, recipient} index stays unique. The merge
+    deletes the old entry and adds its amount in one transaction, so an interrupted run never counts a debt twice.
+    Return value: number of migrated documents
+    """
+    migrated = 0
+    async for entry in outstanding_payments_collection.find({"guild_id": {"$exists": False}}):
+        try:
+            await outstanding_payments_collection.update_one({"_id": entry["_id"]}, {"$set": {"guild_id": guild_id}})
+        except pymongo.errors.DuplicateKeyError:
+            async with await outstanding_payments_collection.database.client.start_session() as session:
+                async with session.start_transaction():
+                    deleted = await outstanding_payments_collection.delete_one({"_id": entry["_id"], "guild_id": {"$exists": False}}, session=session)
+                    if deleted.deleted_count == 0: #already merged by a concurrent run
+                        continue
+                    await outstanding_payments_collection.update_one({"guild_id": guild_id, "debtor": entry["debtor"], "recipient": entry["recipient"]},
+                                                                     {"$inc": {"amount_cents": entry["amount_cents"]}}, session=session)
+        migrated += 1
+    return migrated
+
+
+async def main():
+    import database #imported here since database imports this module for its startup migrations
+
+    parser = argparse.ArgumentParser(description="Migrate stored documents to the current format")
+    parser.add_argument("--guild-id", type=int, help="guild to move outstanding payments without a guild_id into")
+    args = parser.parse_args()
+
+    try:
+        migrated = await migrate_outstanding_payments_to_cents(database.outstanding_payments_collection)
+        print(f"Migrated {migrated} outstanding_payments entries to integer cents")
+
+        dropped = await drop_unscoped_indexes(database.outstanding_payments_collection)
+        print(f"Dropped unscoped indexes: {', '.join(dropped) if dropped else 'none'}")
+        await database.ensure_indexes()
+
+        if args.guild_id != None:
+            migrated = await assign_guild_to_outstanding_payments(database.outstanding_payments_collection, args.guild_id)
+            print(f"Moved {migrated} outstanding_payments entries into guild {args.guild_id}")
+        unscoped = await count_unscoped_outstanding_payments(database.outstanding_payments_collection)
+        if unscoped > 0:
+            print(f"{unscoped} outstanding_payments entries have no guild_id, run again with --guild-id to assign them")
+    except Exception as e:
+        print(f"Error while migrating outstanding_payments entries: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
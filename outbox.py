@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import sqlite3
+import datetime
+import threading
+from collections import defaultdict
+import pymongo.errors
+from bson import ObjectId
+import database
+import metrics
+import ledger
+
+#--GAME OUTBOX--#
+#Write-behind journal for recorded games. /record-game appends the settled game to a local SQLite file (WAL mode, fsynced
+#on commit) and answers right away, and a background task drains the journal into Mongo in batches. Each game gets an
+#ObjectId up front that becomes its games archive _id, and the archive insert commits in the same transaction as its
+#ledger writes, so a game that reached Mongo but wasn't removed from the journal (crash, timeout) is detected by the
+#duplicate key and never applied twice. Failed batches are retried with exponential backoff, games are never dropped.
+
+OUTBOX_PATH = os.getenv('OUTBOX_PATH', 'outbox.db') #give every process its own file (and keep it on a volume in docker)
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '300')) #seconds, cap on the backoff between attempts at a failing game
+
+log = logging.getLogger(__name__)
+
+
+class GameOutbox:
+    """
+    Durable queue of games waiting to be written to Mongo.
+    settle is an async callable like SettlementExecutor.settle, used to fold games into the ledger when incremental is True.
+    on_applied is an optional callable run with the guild id of every game that reached Mongo.
+    """
+
+    def __init__(self, settle, path=OUTBOX_PATH, batch_size=OUTBOX_BATCH_SIZE, incremental=False, on_applied=None):
+        self.settle = settle
+        self.path = path
+        self.batchSize = batch_size
+        self.incremental = incremental
+        self.onApplied = on_applied
+        self.connection = None
+        self.lock = threading.Lock() #one sqlite connection shared by the to_thread workers
+        self.wakeup = asyncio.Event()
+
+        #metrics
+        self.applied = 0
+        self.duplicates = 0
+        self.failures = 0
+
+    #--LOCAL JOURNAL (runs in worker threads)--#
+
+    def open(self):
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL") #fsync every commit, an acknowledged game must survive a crash
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS games (
+                id TEXT PRIMARY KEY,
+                guild_id INTEGER NOT NULL,
+                recorded_by INTEGER NOT NULL,
+                recorded_at REAL NOT NULL,
+                game_data TEXT NOT NULL,
+                transactions TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                last_error TEXT
+            )""")
+
+    def close(self):
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+
+    def _insert(self, row):
+        with self.lock:
+            self.connection.execute("INSERT INTO games (id, guild_id, recorded_by, recorded_at, game_data, transactions) VALUES (?, ?, ?, ?, ?, ?)", row)
+
+    def _due(self, limit):
+        with self.lock:
+            return self.connection.execute("SELECT id, guild_id, recorded_by, recorded_at, game_data, transactions, attempts FROM games "
+                                           "WHERE next_attempt_at <= ? ORDER BY recorded_at LIMIT ?", (time.time(), limit)).fetchall()
+
+    def _delete(self, game_ids):
+        with self.lock:
+            self.connection.executemany("DELETE FROM games WHERE id = ?", [(game_id,) for game_id in game_ids])
+
+    def _reschedule(self, game_id, attempts, error):
+        delay = min(2 ** attempts, OUTBOX_RETRY_MAX) * random.uniform(0.5, 1.0) #jittered so failing games don't retry in lockstep
+        with self.lock:
+            self.connection.execute("UPDATE games SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                                    (attempts, time.time() + delay, str(error)[:500], game_id))
+
+    def _count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def pending_count(self):
+        return self._count() if self.connection != None else 0
+
+    #--ASYNC API--#
+
+    async def enqueue(self, guild_id, recorded_by, game_data, transactions=None):
+        """
+        Durably journal a validated game (transactions from the settlement algorithm, or None to fold it into the ledger when drained).
+        Return value: the game's id, which becomes its games archive _id
+        """
+        game_id = str(ObjectId())
+        await asyncio.to_thread(self._insert, (game_id, guild_id, recorded_by, time.time(), json.dumps(game_data),
+                                               json.dumps(transactions) if transactions != None else None))
+        self.wakeup.set()
+        return game_id
+
+    async def run(self):
+        """Drain the journal into Mongo until cancelled, waking up when a game is enqueued (or every few seconds for retries)."""
+        while True:
+            try:
+                applied = await self.drain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e: #local journal errors, keep the loop alive
+                log.exception(f"Error draining the game outbox: {e}")
+                applied = 0
+
+            if applied < self.batchSize: #caught up, wait for new games or the next retry
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain_once(self):
+        """Write one batch of due games to Mongo. Return value: number of games taken off the journal"""
+        rows = await asyncio.to_thread(self._due, self.batchSize)
+        if len(rows) == 0:
+            return 0
+
+        games = [{
+            "id": game_id,
+            "guild_id": guild_id,
+            "recorded_by": recorded_by,
+            "recorded_at": datetime.datetime.fromtimestamp(recorded_at, datetime.timezone.utc),
+            "game_data": json.loads(game_data),
+            "transactions": json.loads(transactions) if transactions != None else None,
+            "attempts": attempts,
+        } for game_id, guild_id, recorded_by, recorded_at, game_data, transactions, attempts in rows]
+
+        #games journaled without transactions (incremental mode, or before SETTLEMENT_MODE was switched) are folded in one at a time
+        batch = [game for game in games if not self.incremental and game["transactions"] != None]
+        single = [game for game in games if self.incremental or game["transactions"] == None]
+        done = []
+        if len(batch) > 1:
+            try:
+                await self.apply_batch(batch)
+                self.applied += len(batch)
+                done.extend(batch)
+                batch = []
+            except Exception as e: #one game already applied, a transient failure or a bad game: settle it game by game
+                log.info(f"Outbox batch failed, applying games one at a time: {e}", extra={"games": len(batch)})
+
+        for game in batch + single: #apply_one reschedules a failing game on its own, so it never holds up the rest
+            if await self.apply_one(game):
+                done.append(game)
+
+        await asyncio.to_thread(self._delete, [game["id"] for game in done])
+        if self.onApplied != None:
+            for guild_id in dict.fromkeys(game["guild_id"] for game in done):
+                self.onApplied(guild_id)
+        return len(done)
+
+    async def apply_batch(self, games):
+        """Write several appended (already settled) games in one transaction, with one bulk_write per collection for the ledger."""
+        by_guild = defaultdict(list)
+        for game in games:
+            by_guild[game["guild_id"]].append(game)
+
+        async with metrics.stage("mongo"):
+            async with await database.start_session() as session:
+                async with session.start_transaction():
+                    for guild_id, guild_games in by_guild.items():
+                        transactions = [transaction for game in guild_games for transaction in game["transactions"]]
+                        await database.create_outstanding_payments_entries(guild_id, transactions, session)
+                        for game in guild_games:
+                            await database.archive_game(guild_id, game["game_data"], game["recorded_by"], session, ObjectId(game["id"]), game["recorded_at"])
+
+    async def apply_one(self, game):
+        """Write one game. Return value: True if it reached Mongo (now or in an earlier attempt), False if it was rescheduled"""
+        try:
+            if game["transactions"] == None:
+                await ledger.fold_game_into_ledger(game["guild_id"], game["game_data"], self.settle, game["recorded_by"],
+                                                   game_id=ObjectId(game["id"]), recorded_at=game["recorded_at"])
+            else:
+                await self.apply_batch([game])
+            self.applied += 1
+            return True
+
+        except pymongo.errors.DuplicateKeyError as e:
+            #the archive _id clashed: committed by an earlier attempt that didn't get to remove it from the journal
+            #(any other unique index clash, like two concurrent upserts of the same pair, is just retried)
+            if await database.game_exists(ObjectId(game["id"])):
+                self.duplicates += 1
+                return True
+            error = e
+
+        except Exception as e:
+            error = e
+
+        self.failures += 1
+        log.warning(f"Could not write outbox game to the database, retrying later: {error}", extra={"game_id": game["id"], "attempts": game["attempts"] + 1})
+        await asyncio.to_thread(self._reschedule, game["id"], game["attempts"] + 1, error)
+        return False
@@ -1,148 +1,131 @@
 import os
+import io
+import re
 import discord
 import asyncio
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 from dotenv import load_dotenv
-import pymongo.client_session
-from pymongo.mongo_client import MongoClient
-from pymongo.server_api import ServerApi
-import pymongo.errors
 import utilities
+import database
+import settlement_service
+import settlement_cache
+import outbox
+import dm_dispatch
+import ledger
+import metrics
+import lifecycle
+import logging
+import signal
 import sys
 
 load_dotenv()
+metrics.configure_logging() #one JSON object per log line
+log = logging.getLogger("pokerBot")
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-DB_USERNAME = os.getenv('DB_USERNAME')
-DB_PASSWORD = os.getenv('DB_PASSWORD')
-DB_CLUSTER_STRING = os.getenv('DB_CLUSTER_STRING')
+SETTLEMENT_WORKERS = int(os.getenv('SETTLEMENT_WORKERS', '2'))
+SETTLEMENT_TIME_BUDGET = float(os.getenv('SETTLEMENT_TIME_BUDGET', '2.0')) #seconds before falling back to greedy settlement
+SETTLEMENT_CACHE_SIZE = int(os.getenv('SETTLEMENT_CACHE_SIZE', '4096'))
+SETTLEMENT_CACHE_PATH = os.getenv('SETTLEMENT_CACHE_PATH') #file the settlement cache is saved to (periodically and on shutdown) and loaded from on startup (unset keeps it in memory only)
+SETTLEMENT_CACHE_SAVE_INTERVAL = float(os.getenv('SETTLEMENT_CACHE_SAVE_INTERVAL', '10')) #minutes between saves of the settlement cache
+GAME_OUTBOX = os.getenv('GAME_OUTBOX', '0') == '1' #journal recorded games locally and answer right away, a background task writes them to the database
+SETTLEMENT_MODE = os.getenv('SETTLEMENT_MODE', 'append') #'append' (settle each game on its own) or 'incremental' (re-settle the game with its players' outstanding edges)
+MAX_IMPORT_PLAYERS = int(os.getenv('MAX_IMPORT_PLAYERS', '100'))
+MAX_IMPORT_BYTES = 256000
+PAYMENTS_PER_PAGE = min(int(os.getenv('PAYMENTS_PER_PAGE', '10')), 10) #payment links per /make-payments message, discord allows up to 10 embeds per message
+LEDGER_COMPACTION = os.getenv('LEDGER_COMPACTION', 'off') #'after-game' (after each /record-game), 'scheduled' (every LEDGER_COMPACTION_INTERVAL minutes) or 'off'
+LEDGER_COMPACTION_INTERVAL = float(os.getenv('LEDGER_COMPACTION_INTERVAL', '60'))
+SHARD_COUNT = os.getenv('SHARD_COUNT') #unset runs a single unsharded gateway connection
+SHARD_IDS = utilities.parse_shard_ids(os.getenv('SHARD_IDS')) if os.getenv('SHARD_IDS') else None #e.g. "0-3" to split a fleet across processes (needs a numeric SHARD_COUNT)
 
 #default intents with members enabled
 intents = discord.Intents.default()
 intents.members = True #now needs privileged intents enabled for members
 intents.message_content = True
 
-#create bot object to interact with discord API 
-bot = commands.Bot(command_prefix='/', intents=intents)
+#create bot object to interact with discord API
+#sharded mode: each process runs SHARD_IDS (all shards if unset) of SHARD_COUNT gateway connections ('auto' uses discord's recommendation)
+if SHARD_COUNT == None:
+    bot = commands.Bot(command_prefix='/', intents=intents)
+else:
+    bot = commands.AutoShardedBot(command_prefix='/', intents=intents,
+                                  shard_count=None if SHARD_COUNT == 'auto' else int(SHARD_COUNT), shard_ids=SHARD_IDS)
 
-#--Connect to MongoDB database--#
-db_url = f'mongodb+srv://{DB_USERNAME}:{DB_PASSWORD}@{DB_CLUSTER_STRING}'
+#settlements of game shapes seen before, keyed by the sorted debts so they're reused across players
+settlement_result_cache = settlement_cache.SettlementCache(maxsize=SETTLEMENT_CACHE_SIZE, path=SETTLEMENT_CACHE_PATH)
 
-# Create a new client and connect to the server
-db_client = MongoClient(db_url, server_api=ServerApi('1'))
-# Send a ping to confirm a successful connection
-try:
-    db_client.admin.command('ping')
-    print("Pinged your deployment. You successfully connected to MongoDB!")
-except Exception as e:
-    print(e)
+#process pool that runs the debt settlement algorithm off the event loop
+settlement_executor = settlement_service.SettlementExecutor(max_workers=SETTLEMENT_WORKERS, time_budget=SETTLEMENT_TIME_BUDGET, cache=settlement_result_cache)
 
-db = db_client.discordBot #create a new database in cluster called "discordBot" if does not exist
-users_collection = db.users #create a new "users" collection (table) in discordBot database if doesn't exist
-outstanding_payments_collection = db.outstanding_payments #create a new "outstanding_payments" collection (table) in discordBot database if doesn't exist
+#references to long running background tasks so they aren't garbage collected
+background_tasks = set()
 
-try:
-    outstanding_payments_collection.create_index({"debtor": 1, "recipient": 1}, unique=True)
-except pymongo.errors.PyMongoError as e:
-    print(f"An error occurred while creating the unique index in outstanding_payments_collection: {e}")
+#runs once a recorded game is in the database
+def after_game_recorded(guild_id):
+    if LEDGER_COMPACTION == 'after-game': #net the new edges against the rest of the ledger without delaying the response
+        background_tasks.add(asyncio.create_task(run_ledger_compaction(guild_id)))
 
+#local write-behind journal of recorded games (only used if GAME_OUTBOX is enabled)
+game_outbox = outbox.GameOutbox(settlement_executor.settle, incremental=SETTLEMENT_MODE == 'incremental', on_applied=after_game_recorded)
 
 #--ERROR HANDLING--#
 
 #general uncaught bot error handler
 @bot.event
 async def on_error(event, *args):
-    print(f'Uncaught Error: {event}')
-    print(sys.exc_info())
+    log.error(f'Uncaught Error: {event}', exc_info=sys.exc_info())
 
 #general uncaught command error handler
 @bot.event
 async def on_command_error(ctx, error):
-    print(f'Uncaught Command Error: {error}')
-
-
-#--DATABASE OPERATION WRAPPERS--#
-
-#implements insert if non-existant entry or update if entry exists 
-async def create_users_entry(discord_id, username):
-    try:
-        user_entry = {"_id": discord_id, "venmo_usr": username}
-        users_collection.insert_one(user_entry)
-        return True
-    except pymongo.errors.DuplicateKeyError as e: #entry exists
-        print(f"Duplicate key error in create_users_entry, updating entry instead")
-        users_collection.update_one({"_id": discord_id}, {"$set": {"venmo_usr": username}})
-        return True
-    except Exception as e:
-        print(f"Unknown error in create_users_entry: {e}")
-        return False
-    
-
-async def get_users_entry(discord_id):
-    try:
-        result = users_collection.find_one({"_id": discord_id})
-        return result
-    except Exception as e:
-        print(f"Unknown error in get_users_entry: {e}")
-        return None
-
-
-
-#implements insert if non-existant entry or update if entry exists, must pass in the session for ACID transaction (all or nothing)
-async def create_outstanding_payments_entry(discord_id_debtor: int, discord_id_recipient: int, amount: float, session: pymongo.client_session.ClientSession):
-    if not (isinstance(discord_id_debtor, int) and isinstance(discord_id_recipient, int) and isinstance(amount, (int, float)) and isinstance(session, pymongo.client_session.ClientSession)):
-        print("create_outstanding_payments_entry parameters are incorrect types")
-        raise TypeError("create_outstanding_payments_entry parameters are incorrect types")
-    
-    #fields: discord id of person who owes money, discord id of person to whom money is owed (can't be their venmo since it can change in users table), amount
-    #outstanding_payments_entry = {"debtor": discord_id_debtor, "recipient": discord_id_recipient, "amount": amount}
-
-    #upsert (insert if not present, update other wise)
-    outstanding_payments_collection.update_one({"debtor": discord_id_debtor, "recipient": discord_id_recipient}, {"$inc": {"amount": amount}}, upsert=True, session=session)
-
-
-
-async def get_outstanding_payments_entries(discord_id):
-    try:
-        result = outstanding_payments_collection.aggregate([
-            {'$match': {'debtor': discord_id}},
-            {
-                '$lookup': 
-                {
-                    "from": "users",
-                    "localField": "recipient",
-                    "foreignField": "_id",
-                    "as": "results"
-                }
-            }
-        ])
-
-        return result
-
-    except Exception as e:
-        print(f"Unknown error in get_outstanding_payments_entries: {e}")
-        return None
-    
-
-async def delete_outstanding_payments_entry(discord_id_debtor, discord_id_recipient):
-    try:
-        res = outstanding_payments_collection.delete_one({"debtor": discord_id_debtor, "recipient": discord_id_recipient})
-        if res == 0: #somehow unable to delete the document
-            print("Unable to find outstanding payments entry to delete")
-            return False
-        else:
-            return True
-    except Exception as e:
-        print(f"Uknown error in delete_outstanding_payments_entry: {e}")
-        return False
+    log.error(f'Uncaught Command Error: {error}')
 
 
 #--EVENTS--#
+@bot.event
+async def setup_hook():
+    lifecycle.record_phase("setup_hook")
+    if GAME_OUTBOX:
+        await asyncio.to_thread(game_outbox.open)
+        metrics.register_gauge("pokerbot_outbox_pending_games", "Recorded games not written to the database yet", game_outbox.pending_count)
+    #don't hold up the gateway connection on Atlas, commands that need the database wait for lifecycle.db_ready
+    background_tasks.add(asyncio.create_task(lifecycle.warm_up_database(on_ready=start_database_tasks)))
+
+    metrics.instrument_discord_http(bot.http)
+    metrics.register_gauge("pokerbot_settlement_queue_depth", "Settlement calls waiting on or running in the process pool",
+                           lambda: settlement_executor.queueDepth)
+    metrics.register_gauge("pokerbot_settlement_timeouts", "Settlement calls that fell back to greedy settlement",
+                           lambda: settlement_executor.timeouts)
+    metrics.register_gauge("pokerbot_settlement_cache_hits", "Settlements answered from the settlement cache", lambda: settlement_result_cache.get_stats()["hits"])
+    metrics.register_gauge("pokerbot_settlement_cache_misses", "Settlements that had to run the algorithm", lambda: settlement_result_cache.get_stats()["misses"])
+    metrics.register_gauge("pokerbot_users_cache_hits", "Venmo username cache hits", lambda: database.users_cache.hits)
+    metrics.register_gauge("pokerbot_users_cache_misses", "Venmo username cache misses", lambda: database.users_cache.misses)
+    metrics.register_gauge("pokerbot_dm_refused_cache_size", "Users who recently refused a DM and are skipped",
+                           lambda: len(dm_dispatch.dm_refused_cache))
+    background_tasks.add(asyncio.create_task(metrics.monitor_event_loop_lag()))
+    await metrics.start_server()
+
+    if SETTLEMENT_CACHE_PATH != None: #a kill (OOM, docker's timeout) skips the save on shutdown, so save as we go too
+        scheduled_settlement_cache_save.start()
+    try: #docker stop sends SIGTERM, which bot.run doesn't handle: close the bot so the shutdown below __main__ runs
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: background_tasks.add(asyncio.create_task(bot.close())))
+    except NotImplementedError: #no signal handlers on windows event loops
+        pass
+
+async def start_database_tasks():
+    if GAME_OUTBOX:
+        background_tasks.add(asyncio.create_task(game_outbox.run())) #also drains games journaled before a restart
+    if LEDGER_COMPACTION == 'scheduled':
+        scheduled_ledger_compaction.start()
+    if database.USERS_CHANGE_STREAM:
+        background_tasks.add(asyncio.create_task(database.watch_users_changes())) #keep cached Venmo usernames coherent across replicas
+
 @bot.event
 async def on_ready():
+    lifecycle.record_phase("gateway_ready")
     # await bot.tree.sync(guild=discord.Object(id=1246667177759608932))
     # await bot.tree.sync()
-    print(f'{bot.user.name} has connected to Discord!')
+    log.info(f'{bot.user.name} has connected to Discord!', extra={"shard_ids": getattr(bot, "shard_ids", None), "shard_count": bot.shard_count})
 
 
 async def get_venmo_user(member, channel, interaction, hasRespondedInteraction):
@@ -157,7 +140,7 @@ async def get_venmo_user(member, channel, interaction, hasRespondedInteraction):
             await interaction.response.send_message(embed=embed)
 
     except Exception as e:
-        print(f"Error while sending message to get user's Venmo account: {e}")
+        log.error(f"Error while sending message to get user's Venmo account: {e}")
     
     def check(msg):
         return msg.channel == channel and msg.author == member
@@ -207,30 +190,23 @@ async def get_venmo_user(member, channel, interaction, hasRespondedInteraction):
 
 @bot.event
 async def on_member_join(member):
-    if await utilities.can_dm_user(member):
-        await member.dm_channel.send(f'Hey {member.name}! Please use the \"**/verify-venmo**\" command if you want to connect your Venmo username to your account to receive future Poker earnings.')
+    #just try the real send, its outcome is cached for later payouts (no probe message first)
+    await dm_dispatch.send_dm(member, content=f'Hey {member.name}! Please use the \"**/verify-venmo**\" command if you want to connect your Venmo username to your account to receive future Poker earnings.')
               
 
 # @bot.tree.command(name='connect-venmo', description="Connect your Venmo username to your account to receive future Poker earnings", guild=discord.Object(id=1246667177759608932))
 @bot.tree.command(name='connect-venmo', description="Connect your Venmo username to your account to receive future Poker earnings")
 @app_commands.describe(username='Your Venmo username (the name after the \"@\")')
 @commands.max_concurrency(number=1, per=commands.BucketType.user, wait=False) #Ensures command can only be used 1 time per user concurrently
+@metrics.timed_command('connect-venmo')
+@lifecycle.requires_database
 async def verify_venmo_cmd(interaction, username: str):
     # hasRespondedInteraction = False
 
-    # if await utilities.can_dm_user(interaction.user):
-    #     if interaction.channel != interaction.user.dm_channel:
-    #         await interaction.response.send_message(f'{interaction.user.mention} Please check dms!')
-    #         hasRespondedInteraction = True
-
-    #     channel = interaction.user.dm_channel
-    # else:
-    #     channel = interaction.channel
-
     # username = await get_venmo_user(interaction.user, channel, interaction, hasRespondedInteraction)
 
     if username != None:
-        if await create_users_entry(interaction.user.id, username) == True:
+        if await database.create_users_entry(interaction.user.id, username) == True:
             embed = discord.Embed(title= f'✅ Your Venmo account has been confirmed, {interaction.user.name}. Thank you!', description=f'Your username has been recorded as \"**@{username}**\".', color=0x00ff00)
         else:
             embed = discord.Embed(title= f'❌ Error in confirming Venmo account for {interaction.user.name}. Please try again.', color=0xf50000)
@@ -248,6 +224,8 @@ async def verify_venmo_cmd(interaction, username: str):
                        player6="Player name", player6_buy_in="Monetary value of the player's buy-in", player6_winnings="Monetary value of the player's remaining chips",
                        player7="Player name", player7_buy_in="Monetary value of the player's buy-in", player7_winnings="Monetary value of the player's remaining chips",
                        player8="Player name", player8_buy_in="Monetary value of the player's buy-in", player8_winnings="Monetary value of the player's remaining chips",)
+@metrics.timed_command('get-game-payments')
+@lifecycle.requires_database
 async def immediate_payout_game_cmd(interaction, player1: discord.Member, player1_buy_in: float, player1_winnings: float,
                            player2: discord.Member = None, player2_buy_in: float = None, player2_winnings: float = None,
                            player3: discord.Member = None, player3_buy_in: float = None, player3_winnings: float = None,
@@ -258,10 +236,10 @@ async def immediate_payout_game_cmd(interaction, player1: discord.Member, player
                            player8: discord.Member = None, player8_buy_in: float = None, player8_winnings: float = None):
     
     maxParameters = 8
-    data = [] # list of lists, where each list has the form [player_id, player_buy_in, player_winnings]
+    data = [] # list of lists, where each list has the form [player_id, player_buy_in_cents, player_winnings_cents]
 
     distinctPlayers = set() # set to make sure no duplicate players
-    unauthenticatedPlayers = [] #list of unauthenticated players
+    players = [] #discord.member of every submitted player, verified against the users collection in one query after the loop
     for i in range(maxParameters): #Access all parameters easily, ensure all players have a corresponding buy in and winnings
         player = f"player{i+1}"
         playerBuyIn = f"player{i+1}_buy_in"
@@ -278,8 +256,6 @@ async def immediate_payout_game_cmd(interaction, player1: discord.Member, player
                 embed = discord.Embed(title= f'❌ Invalid Arguments', description='Please make sure there are no negative values. A player who lost all chips would have a winnings value of 0.', color=0xf50000)
                 await interaction.response.send_message(embed=embed)
                 return
-            elif await get_users_entry(player.id) == None: #at least one player is not authenticated, add to list so at end we can report all unauthenticated players
-                unauthenticatedPlayers.append(player) #discord.member
 
             #no duplicate players
             if player.id in distinctPlayers:
@@ -288,7 +264,8 @@ async def immediate_payout_game_cmd(interaction, player1: discord.Member, player
                 return
 
             distinctPlayers.add(player.id)
-            data.append([player.id, round(playerBuyIn, 2), round(playerWinnings, 2)]) #[player_id, player_buy_in, player_winnings]
+            players.append(player)
+            data.append([player.id, utilities.to_cents(playerBuyIn), utilities.to_cents(playerWinnings)]) #[player_id, player_buy_in_cents, player_winnings_cents]
 
         elif player or playerBuyIn != None or playerWinnings != None: #if above is false but at least 1 is not None, reply with error message
             embed = discord.Embed(title= f'❌ Invalid Arguments', description='Please make sure the player name, buy-in, and winnings are recorded for each submitted player.', color=0xf50000)
@@ -296,6 +273,16 @@ async def immediate_payout_game_cmd(interaction, player1: discord.Member, player
             return
 
 
+    #fetch every player's users entry in a single $in query
+    venmoUsers = await database.get_users_entries(list(distinctPlayers)) #dict of discord id -> users entry
+    if venmoUsers == None:
+        embed = discord.Embed(title= f'❌ Database Error', description= f'We encountered an error in synchronizing our systems. Please try again.', color=0xf50000)
+        await interaction.response.send_message(embed=embed)
+        return
+
+    #at least one player is not authenticated, report all unauthenticated players
+    unauthenticatedPlayers = [player for player in players if player.id not in venmoUsers] #list of unauthenticated players
+
     #have unauthenticated players, tell user they cannot record a game if all players don't have Venmo verified
     if len(unauthenticatedPlayers) > 0:
             unverifiedUsers = ''
@@ -318,20 +305,20 @@ async def immediate_payout_game_cmd(interaction, player1: discord.Member, player
     #run poker debt settlement algo with error checking
     transactions = []
     try:
-        transactions = utilities.poker_debt_settlement_algo(data)
+        transactions = await settlement_executor.settle(data) #runs in a worker process, greedy fallback if over the time budget
 
         if transactions == None: #None returned if nonzero sum
             embed = discord.Embed(title= f'❌ Invalid Values', description= f'Please make sure the sum of player buy-ins equals the sum of player winnings.', color=0xf50000)
             await interaction.followup.send(embed=embed)
 
-            print("Error in given arguments: Nonzero total sum")
+            log.info("Error in given arguments: Nonzero total sum")
             return
 
     except Exception as e:
         embed = discord.Embed(title= f'❌ Unknown Error', description= f'An unknown error has occurred in our algorithm. Please try again.', color=0xf50000)
         await interaction.followup.send(embed=embed)
 
-        print(f"Error in poker debt settlement algorithm: {e}")
+        log.exception(f"Error in poker debt settlement algorithm: {e}")
         return
     
 
@@ -339,28 +326,132 @@ async def immediate_payout_game_cmd(interaction, player1: discord.Member, player
     await interaction.followup.send(embed=embed)
 
 
+    #build every payment link first, then DM them all concurrently
+    messages = [] #(debtor, embed) to DM
+    fallbackEmbeds = [] #embed to post in the channel instead if the DM fails
     for transaction in transactions:
-        venmo_usr = await get_users_entry(transaction[1]) #recipient venmo info
-        venmo_usr = venmo_usr['venmo_usr']
-        amount = format(transaction[2], '.2f')
+        venmo_usr = venmoUsers[transaction[1]]['venmo_usr'] #recipient venmo info, already fetched during verification
+        amount = utilities.format_cents(transaction[2])
 
         paymentURL = f"https://venmo.com?url=venmo://paycharge?txn=pay&recipients=@{venmo_usr}&amount={amount}&note=game"
 
         debtor = bot.get_user(transaction[0])
 
-        if await utilities.can_dm_user(debtor):
-            embed = discord.Embed(title= f"Payment of **${amount}** to **@{venmo_usr}**.", description=paymentURL, color=0x00ff00)
-            await debtor.dm_channel.send(embed=embed)
+        messages.append((debtor, discord.Embed(title= f"Payment of **${amount}** to **@{venmo_usr}**.", description=paymentURL, color=0x00ff00)))
+        fallbackEmbeds.append(discord.Embed(title= f"Payment of **${amount}** to **@{venmo_usr}**.", description=f"<@{transaction[0]}>: {paymentURL}", color=0x00ff00))
+
+    results = await dm_dispatch.dispatch_dms(messages)
+
+    #links that couldn't be DMed go to the channel, grouped into as few followup messages as possible
+    failed = [i for i in range(len(results)) if not results[i]["success"]]
+    for i in failed:
+        log.info(f"Could not DM payment link: {results[i]['error']}", extra={"user_id": transactions[i][0]})
+
+    for chunk in dm_dispatch.chunk_embeds(failed):
+        mentions = ' '.join(dict.fromkeys(f'<@{transactions[i][0]}>' for i in chunk)) #ping each debtor once
+        await interaction.followup.send(content=mentions, embeds=[fallbackEmbeds[i] for i in chunk])
+
+
+
+
+#sends embed as the interaction response, or as a followup if the interaction was already responded to or deferred
+async def send_response(interaction, embed):
+    if interaction.response.is_done():
+        await interaction.followup.send(embed=embed)
+    else:
+        await interaction.response.send_message(embed=embed)
+
+
+#shared pipeline for every way of recording a game: verify players, settle, write the ledger
+#data is a list of lists, where each list has the form [player_id, player_buy_in_cents, player_winnings_cents] (no duplicates, no negatives)
+async def record_game(interaction, data):
+    #fetch every player's users entry in a single $in query
+    venmoUsers = await database.get_users_entries([row[0] for row in data]) #dict of discord id -> users entry
+    if venmoUsers == None:
+        embed = discord.Embed(title= f'❌ Database Error', description= f'We encountered an error in synchronizing our systems. Please try again.', color=0xf50000)
+        await send_response(interaction, embed)
+        return
+
+    #at least one player is not authenticated, report all unauthenticated players
+    unauthenticatedPlayers = [row[0] for row in data if row[0] not in venmoUsers] #list of unauthenticated player ids
+
+    #have unauthenticated players, tell user they cannot record a game if all players don't have Venmo verified
+    if len(unauthenticatedPlayers) > 0:
+            unverifiedUsers = ''
+            for p in unauthenticatedPlayers:
+                unverifiedUsers += f'<@{p}>, '
+
+            embed = discord.Embed(title= f'❌ Unverified Players', description= f'Users: {unverifiedUsers}have not been verified. Please make sure all players have used the \"**/verify-venmo**\" command.', color=0xf50000)
+            await send_response(interaction, embed)
+            return
+    
+    #Must have more than one player
+    if len(data) <= 1:
+        embed = discord.Embed(title= f'❌ Invalid Number of Players', description= f'You must have at least 2 players.', color=0xf50000)
+        await send_response(interaction, embed)
+        return
+
+    #if made it here that means no errors in parameters passed in, defer response while debt settlement algo runs
+    if not interaction.response.is_done():
+        await interaction.response.defer()
+
+    #run poker debt settlement algo with error checking
+    transactions = []
+    try:
+        if SETTLEMENT_MODE == 'incremental': #the game is settled together with its players' outstanding edges below, only validate it here
+            if utilities.get_player_debts(data) == None:
+                transactions = None
         else:
-            # await interaction.followup.send(f"{debtor.mention}")
-            embed = discord.Embed(title= f"Payment of **${amount}** to **@{venmo_usr}**.", description=f"{debtor.mention}: {paymentURL}", color=0x00ff00)
+            transactions = await settlement_executor.settle(data) #runs in a worker process, greedy fallback if over the time budget
+
+        if transactions == None: #None returned if nonzero sum
+            embed = discord.Embed(title= f'❌ Invalid Values', description= f'Please make sure the sum of player buy-ins equals the sum of player winnings.', color=0xf50000)
             await interaction.followup.send(embed=embed)
 
+            log.info("Error in given arguments: Nonzero total sum")
+            return
+
+    except Exception as e:
+        embed = discord.Embed(title= f'❌ Unknown Error', description= f'An unknown error has occurred in our algorithm. Please try again.', color=0xf50000)
+        await interaction.followup.send(embed=embed)
+
+        log.exception(f"Error in poker debt settlement algorithm: {e}")
+        return
+    
+
+    #start a session to perform ACID transaction insert of new payment records (if one operation fails, performs rollback of all previous operations in transaction)
+    try:
+        if GAME_OUTBOX: #durable once journaled, the outbox writes it (and runs after_game_recorded) in the background
+            await game_outbox.enqueue(interaction.guild_id, interaction.user.id, data, transactions if SETTLEMENT_MODE != 'incremental' else None)
+        elif SETTLEMENT_MODE == 'incremental':
+            await ledger.fold_game_into_ledger(interaction.guild_id, data, settlement_executor.settle, interaction.user.id)
+        else:
+            async with metrics.stage("mongo"): #also counts starting the session and the commit round-trip
+                async with await database.start_session() as session: #explicit session, automatically closes session at the end of the with block
+                    async with session.start_transaction(): #automatically calls commit_transaction if block completes normally, but calls abort_transaction if the with block exits with exception
+                        await database.create_outstanding_payments_entries(interaction.guild_id, transactions, session) #one bulk_write for the whole game
+                        await database.archive_game(interaction.guild_id, data, interaction.user.id, session) #buy-ins and winnings for /stats and /leaderboard
+
+
+    except Exception as e:
+        log.error(f"Error in inserting all outstanding payment entries: {e}")
+        embed = discord.Embed(title= f'❌ Database Error', description= f'We encountered an error in synchronizing our systems. Please try again.', color=0xf50000)
+        await interaction.followup.send(embed=embed)
+        return
+
+
+    embed = discord.Embed(title= f'✅ Your game has been recorded, {interaction.user.name}. Thank you!', color=0x00ff00)
+    await interaction.followup.send(embed=embed)
+
+    if not GAME_OUTBOX:
+        after_game_recorded(interaction.guild_id)
+
 
 
 
 # @bot.tree.command(name="record-game", description='Record player winnings from a Poker game for future payment', guild=discord.Object(id=1246667177759608932))
 @bot.tree.command(name="record-game", description='Record player winnings from a Poker game for future payment')
+@app_commands.guild_only() #every guild has its own ledger
 @app_commands.describe(player1="Player name", player1_buy_in="Monetary value of the player's buy-in", player1_winnings="Monetary value of the player's remaining chips",
                        player2="Player name", player2_buy_in="Monetary value of the player's buy-in", player2_winnings="Monetary value of the player's remaining chips",
                        player3="Player name", player3_buy_in="Monetary value of the player's buy-in", player3_winnings="Monetary value of the player's remaining chips",
@@ -369,6 +460,8 @@ async def immediate_payout_game_cmd(interaction, player1: discord.Member, player
                        player6="Player name", player6_buy_in="Monetary value of the player's buy-in", player6_winnings="Monetary value of the player's remaining chips",
                        player7="Player name", player7_buy_in="Monetary value of the player's buy-in", player7_winnings="Monetary value of the player's remaining chips",
                        player8="Player name", player8_buy_in="Monetary value of the player's buy-in", player8_winnings="Monetary value of the player's remaining chips",)
+@metrics.timed_command('record-game')
+@lifecycle.requires_database
 async def record_game_cmd(interaction, player1: discord.Member, player1_buy_in: float, player1_winnings: float,
                            player2: discord.Member = None, player2_buy_in: float = None, player2_winnings: float = None,
                            player3: discord.Member = None, player3_buy_in: float = None, player3_winnings: float = None,
@@ -379,10 +472,9 @@ async def record_game_cmd(interaction, player1: discord.Member, player1_buy_in:
                            player8: discord.Member = None, player8_buy_in: float = None, player8_winnings: float = None):
     
     maxParameters = 8
-    data = [] # list of lists, where each list has the form [player_id, player_buy_in, player_winnings]
+    data = [] # list of lists, where each list has the form [player_id, player_buy_in_cents, player_winnings_cents]
 
     distinctPlayers = set() # set to make sure no duplicate players
-    unauthenticatedPlayers = [] #list of unauthenticated players
     for i in range(maxParameters): #Access all parameters easily, ensure all players have a corresponding buy in and winnings
         player = f"player{i+1}"
         playerBuyIn = f"player{i+1}_buy_in"
@@ -399,8 +491,6 @@ async def record_game_cmd(interaction, player1: discord.Member, player1_buy_in:
                 embed = discord.Embed(title= f'❌ Invalid Arguments', description='Please make sure there are no negative values. A player who lost all chips would have a winnings value of 0.', color=0xf50000)
                 await interaction.response.send_message(embed=embed)
                 return
-            elif await get_users_entry(player.id) == None: #at least one player is not authenticated, add to list so at end we can report all unauthenticated players
-                unauthenticatedPlayers.append(player) #discord.member
 
             #no duplicate players
             if player.id in distinctPlayers:
@@ -409,7 +499,7 @@ async def record_game_cmd(interaction, player1: discord.Member, player1_buy_in:
                 return
 
             distinctPlayers.add(player.id)
-            data.append([player.id, round(playerBuyIn, 2), round(playerWinnings, 2)]) #[player_id, player_buy_in, player_winnings]
+            data.append([player.id, utilities.to_cents(playerBuyIn), utilities.to_cents(playerWinnings)]) #[player_id, player_buy_in_cents, player_winnings_cents]
 
         elif player or playerBuyIn != None or playerWinnings != None: #if above is false but at least 1 is not None, reply with error message
             embed = discord.Embed(title= f'❌ Invalid Arguments', description='Please make sure the player name, buy-in, and winnings are recorded for each submitted player.', color=0xf50000)
@@ -417,102 +507,295 @@ async def record_game_cmd(interaction, player1: discord.Member, player1_buy_in:
             return
 
 
-    #have unauthenticated players, tell user they cannot record a game if all players don't have Venmo verified
-    if len(unauthenticatedPlayers) > 0:
-            unverifiedUsers = ''
-            for p in unauthenticatedPlayers:
-                unverifiedUsers += f'{p.mention}, '
+    await record_game(interaction, data)
 
-            embed = discord.Embed(title= f'❌ Unverified Players', description= f'Users: {unverifiedUsers}have not been verified. Please make sure all players have used the \"**/verify-venmo**\" command.', color=0xf50000)
-            await interaction.response.send_message(embed=embed)
-            return
+
+    # await create_outstanding_payments_entry(1234, 5678, 32.5)
+    # await create_outstanding_payments_entry(1357, 2468, 17.8)
+    # await create_outstanding_payments_entry(1357, 3579, 23.3)
+    # await create_outstanding_payments_entry(1357, 3579, 15.5)
+    # await create_outstanding_payments_entry(9872, 1627, 12)
     
-    #Must have more than one player
-    if len(data) <= 1:
-        embed = discord.Embed(title= f'❌ Invalid Number of Players', description= f'You must have at least 2 players.', color=0xf50000)
+
+#--BULK GAME IMPORT--#
+
+#finds the guild member an imported player refers to: a mention (<@id>), a raw discord id or a username
+def resolve_member(guild, player):
+    match = re.fullmatch(r'<@!?(\d+)>|(\d+)', player)
+    if match:
+        return guild.get_member(int(match.group(1) or match.group(2)))
+    return guild.get_member_named(player.lstrip('@'))
+
+
+#turns parsed import rows into game data and records it through the same pipeline as /record-game, interaction must already be deferred
+async def record_imported_game(interaction, rows):
+    data = [] # list of lists, where each list has the form [player_id, player_buy_in_cents, player_winnings_cents]
+    distinctPlayers = set() # set to make sure no duplicate players
+    try:
+        for line_number, player, buy_in_cents, winnings_cents in rows:
+            member = resolve_member(interaction.guild, player)
+            if member == None:
+                raise ValueError(f'Row {line_number}: \"{player}\" is not a member of this server')
+            if member.id in distinctPlayers:
+                raise ValueError(f'Row {line_number}: {member.mention} is listed more than once')
+            if len(data) >= MAX_IMPORT_PLAYERS:
+                raise ValueError(f'Games can have at most {MAX_IMPORT_PLAYERS} players')
+
+            distinctPlayers.add(member.id)
+            data.append([member.id, buy_in_cents, winnings_cents])
+
+    except ValueError as e:
+        embed = discord.Embed(title= f'❌ Invalid Game File', description=str(e), color=0xf50000)
+        await interaction.followup.send(embed=embed)
+        return
+
+    await record_game(interaction, data)
+
+
+class ImportGameModal(discord.ui.Modal, title='Import Game'):
+    rows = discord.ui.TextInput(label='Players (one per line: player, buy-in, winnings)', style=discord.TextStyle.paragraph,
+                                placeholder='@alice, 20, 35.50\n@bob, 20, 4.50', max_length=4000)
+
+    @metrics.timed_command('import-game-text')
+    @lifecycle.requires_database
+    async def on_submit(self, interaction):
+        await interaction.response.defer()
+        await record_imported_game(interaction, utilities.parse_game_csv(io.StringIO(self.rows.value)))
+
+
+@bot.tree.command(name="import-game", description='Record a Poker game with any number of players from a CSV or JSON file')
+@app_commands.guild_only() #every guild has its own ledger
+@app_commands.describe(file='CSV with "player, buy-in, winnings" rows, or a JSON list of {"player", "buy_in", "winnings"}')
+@metrics.timed_command('import-game')
+@lifecycle.requires_database
+async def import_game_cmd(interaction, file: discord.Attachment):
+    if file.size > MAX_IMPORT_BYTES:
+        embed = discord.Embed(title= f'❌ File Too Large', description= f'Game files can be at most {MAX_IMPORT_BYTES // 1000} KB.', color=0xf50000)
         await interaction.response.send_message(embed=embed)
         return
 
-    #if made it here that means no errors in parameters passed in, defer response while debt settlement algo runs
     await interaction.response.defer()
 
-    #run poker debt settlement algo with error checking
-    transactions = []
     try:
-        transactions = utilities.poker_debt_settlement_algo(data)
+        text = (await file.read()).decode('utf-8-sig')
+    except (discord.HTTPException, UnicodeDecodeError) as e:
+        log.warning(f"Error reading imported game file: {e}")
+        embed = discord.Embed(title= f'❌ Invalid Game File', description='The file could not be read. Please upload a UTF-8 CSV or JSON file.', color=0xf50000)
+        await interaction.followup.send(embed=embed)
+        return
 
-        if transactions == None: #None returned if nonzero sum
-            embed = discord.Embed(title= f'❌ Invalid Values', description= f'Please make sure the sum of player buy-ins equals the sum of player winnings.', color=0xf50000)
-            await interaction.followup.send(embed=embed)
+    if file.filename.lower().endswith('.json') or text.lstrip().startswith('['):
+        rows = utilities.parse_game_json(text)
+    else:
+        rows = utilities.parse_game_csv(io.StringIO(text)) #parsed lazily line by line while resolving players
 
-            print("Error in given arguments: Nonzero total sum")
-            return
+    await record_imported_game(interaction, rows)
 
-    except Exception as e:
-        embed = discord.Embed(title= f'❌ Unknown Error', description= f'An unknown error has occurred in our algorithm. Please try again.', color=0xf50000)
-        await interaction.followup.send(embed=embed)
 
-        print(f"Error in poker debt settlement algorithm: {e}")
-        return
-    
+@bot.tree.command(name="import-game-text", description='Record a Poker game with any number of players by pasting them in')
+@app_commands.guild_only() #every guild has its own ledger
+async def import_game_text_cmd(interaction):
+    await interaction.response.send_modal(ImportGameModal())
 
-    #start a session to perform ACID transaction insert of new payment records (if one operation fails, performs rollback of all previous operations in transaction)
-    try:
-        with db_client.start_session() as session: #explicit session, automatically closes session at the end of the with block
-            with session.start_transaction(): #automatically calls commit_transaction if block completes normally, but calls abort_transaction if the with block exits with exception
-                for transaction in transactions:
-                    await create_outstanding_payments_entry(transaction[0], transaction[1], transaction[2], session)
 
+#--LEDGER COMPACTION--#
 
+async def run_ledger_compaction(guild_id):
+    try:
+        return await ledger.compact_ledger(guild_id, settlement_executor.settle)
     except Exception as e:
-        print(f"Error in inserting all outstanding payment entries: {e}")
-        embed = discord.Embed(title= f'❌ Database Error', description= f'We encountered an error in synchronizing our systems. Please try again.', color=0xf50000)
-        await interaction.followup.send(embed=embed)
-        return
+        log.exception(f"Error in ledger compaction: {e}")
+        return None
+    finally:
+        background_tasks.discard(asyncio.current_task())
 
 
-    embed = discord.Embed(title= f'✅ Your game has been recorded, {interaction.user.name}. Thank you!', color=0x00ff00)
+@tasks.loop(minutes=LEDGER_COMPACTION_INTERVAL)
+async def scheduled_ledger_compaction():
+    #each process only compacts the guilds on its own shards, one guild at a time
+    for guild in bot.guilds:
+        await run_ledger_compaction(guild.id)
+
+
+@tasks.loop(minutes=SETTLEMENT_CACHE_SAVE_INTERVAL)
+async def scheduled_settlement_cache_save():
+    settlement_result_cache.save()
+
+
+@bot.tree.command(name="compact-ledger", description="Net this server's outstanding payments into the fewest possible payments")
+@app_commands.guild_only() #every guild has its own ledger
+@app_commands.default_permissions(manage_guild=True)
+@metrics.timed_command('compact-ledger')
+@lifecycle.requires_database
+async def compact_ledger_cmd(interaction):
+    await interaction.response.defer()
+    removed = await run_ledger_compaction(interaction.guild_id)
+
+    if removed == None:
+        embed = discord.Embed(title= f'❌ Ledger Busy', description= f'Outstanding payments changed while compacting. Please try again.', color=0xf50000)
+    else:
+        embed = discord.Embed(title= f'✅ Ledger compacted', description= f'Removed **{removed}** outstanding payments.', color=0x00ff00)
     await interaction.followup.send(embed=embed)
 
 
-    # await create_outstanding_payments_entry(1234, 5678, 32.5)
-    # await create_outstanding_payments_entry(1357, 2468, 17.8)
-    # await create_outstanding_payments_entry(1357, 3579, 23.3)
-    # await create_outstanding_payments_entry(1357, 3579, 15.5)
-    # await create_outstanding_payments_entry(9872, 1627, 12)
-    
+class PaymentPagesView(discord.ui.View):
+    """
+    Previous/next buttons that flip one message through pages of embeds, only for the user who ran the command.
+    Only for listings that can be asked for again (the buttons go away after the timeout or a restart).
+    """
+
+    def __init__(self, owner_id, pages):
+        super().__init__(timeout=600)
+        self.ownerId = owner_id
+        self.pages = pages
+        self.page = 0
+        self.message = None
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page == len(self.pages) - 1
+        self.page_label.label = f'{self.page + 1}/{len(self.pages)}'
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.ownerId
+
+    async def show_page(self, interaction, page):
+        self.page = page
+        self.update_buttons()
+        await interaction.response.edit_message(embeds=self.pages[self.page], view=self)
+
+    @discord.ui.button(label='◀', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label='1/1', style=discord.ButtonStyle.secondary, disabled=True)
+    async def page_label(self, interaction, button):
+        pass
+
+    @discord.ui.button(label='▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show_page(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        if self.message != None:
+            try:
+                await self.message.edit(view=None) #the links stay, only the buttons go away
+            except discord.HTTPException:
+                pass
+
 
 # @bot.tree.command(name="make-payments", description='Get 1-tap Venmo links for all outstanding payments you have', guild=discord.Object(id=1246667177759608932))
-@bot.tree.command(name="make-payments", description='Get 1-tap Venmo links for all outstanding payments you have')
+@bot.tree.command(name="make-payments", description='Get 1-tap Venmo links for all outstanding payments you have in this server')
+@app_commands.guild_only() #every guild has its own ledger
+@metrics.timed_command('make-payments')
+@lifecycle.requires_database
 async def payout_cmd(interaction):
-    entries = await get_outstanding_payments_entries(interaction.user.id)
+    #claiming deletes the payments, so acknowledge first: a response that misses the 3 second deadline would lose every link
+    await interaction.response.defer()
+
+    result = await database.claim_outstanding_payments_entries(interaction.guild_id, interaction.user.id)
+    if result == None:
+        embed = discord.Embed(title= f'❌ Database Error', description= f'We encountered an error in synchronizing our systems. Please try again.', color=0xf50000)
+        await interaction.followup.send(embed=embed)
+        return
 
-    count = 0
-    for item in entries:
-        venmo_info = item['results']
+    paid, missing = result
+    for item in missing:
+        log.warning("Recipients venmo account info was not found", extra={"recipient": item['recipient']})
 
-        if len(venmo_info) < 1:
-            print("Recipients venmo account info was not found")
-        else:
-            #delete the outstanding payments entry from the table
-            delete_result = await delete_outstanding_payments_entry(item['debtor'], item['recipient'])
+    if len(paid) == 0: #no entries returned
+        embed = discord.Embed(title= f'❌ No required payouts found for **{interaction.user.name}**.', color=0xf50000)
+        await interaction.followup.send(embed=embed)
+        return
 
-            if delete_result: #successfully deleted
-                amount = format(item['amount'], '.2f')
-                paymentURL = f"https://venmo.com?url=venmo://paycharge?txn=pay&recipients=@{venmo_info[0]['venmo_usr']}&amount={amount}&note=game"
-                embed = discord.Embed(title= f"Payment of **${amount}** to **@{venmo_info[0]['venmo_usr']}**.", description=paymentURL, color=0x00ff00)
-            else: #delete failed
-                embed = discord.Embed(title= f'❌ Database Error', description= f"We encountered an error in synchronizing our systems for your payment of **${item['amount']}** to **@{venmo_info[0]['venmo_usr']}**. Please use the \'**/payout**\' command again to get the link for this payment.", color=0xf50000)
+    embeds = []
+    for item in paid:
+        venmo_usr = item['venmo_usr']
+        amount = utilities.format_cents(item['amount_cents'])
+        paymentURL = f"https://venmo.com?url=venmo://paycharge?txn=pay&recipients=@{venmo_usr}&amount={amount}&note=game"
+        embeds.append(discord.Embed(title= f"Payment of **${amount}** to **@{venmo_usr}**.", description=paymentURL, color=0x00ff00))
 
-            if count == 0:
-                await interaction.response.send_message(embed=embed)
-            else:
-                await interaction.channel.send(embed=embed)
-            count = count + 1
+    #a message per PAYMENTS_PER_PAGE links instead of one per payment. The payments are already off the ledger, so every link
+    #has to stay in the channel (not behind buttons of a view that times out or is lost on a restart)
+    for page in dm_dispatch.chunk_embeds(embeds, PAYMENTS_PER_PAGE):
+        await interaction.followup.send(embeds=page)
 
-    if count == 0: #no entries returned
-        embed = discord.Embed(title= f'❌ No required payouts found for **{interaction.user.name}**.', color=0xf50000)
+
+@bot.tree.command(name="owed-to-me", description='See who still owes you from past Poker games in this server')
+@app_commands.guild_only() #every guild has its own ledger
+@metrics.timed_command('owed-to-me')
+@lifecycle.requires_database
+async def owed_to_me_cmd(interaction):
+    entries = await database.get_incoming_payments_entries(interaction.guild_id, interaction.user.id)
+    if entries == None:
+        embed = discord.Embed(title= f'❌ Database Error', description= f'We encountered an error in synchronizing our systems. Please try again.', color=0xf50000)
+        await interaction.response.send_message(embed=embed)
+        return
+
+    if len(entries) == 0:
+        embed = discord.Embed(title= f'✅ Nobody owes **{interaction.user.name}** anything.', color=0x00ff00)
         await interaction.response.send_message(embed=embed)
+        return
+
+    total = utilities.format_cents(sum(entry['amount_cents'] for entry in entries))
+    lines = [f"<@{entry['debtor']}> owes **${utilities.format_cents(entry['amount_cents'])}**" for entry in entries]
+    embeds = [discord.Embed(title= f'**${total}** owed to **{interaction.user.name}**', description='\n'.join(lines[i:i + 20]), color=0x00ff00)
+              for i in range(0, len(lines), 20)]
+
+    pages = [[embed] for embed in embeds]
+    if len(pages) == 1:
+        await interaction.response.send_message(embeds=pages[0])
+    else:
+        view = PaymentPagesView(interaction.user.id, pages)
+        await interaction.response.send_message(embeds=pages[0], view=view)
+        view.message = await interaction.original_response()
+
+
+
+#--STATS--#
+
+def format_profit(cents):
+    return f'+${utilities.format_cents(cents)}' if cents >= 0 else f'-${utilities.format_cents(-cents)}'
+
+
+@bot.tree.command(name="stats", description="See a player's Poker stats in this server")
+@app_commands.guild_only()
+@app_commands.describe(player='Player to look up (you if left empty)')
+@metrics.timed_command('stats')
+@lifecycle.requires_database
+async def stats_cmd(interaction, player: discord.Member = None):
+    if player == None:
+        player = interaction.user
+
+    stats = await database.get_player_stats(interaction.guild_id, player.id)
+    if stats == False:
+        embed = discord.Embed(title= f'❌ Database Error', description= f'We encountered an error in synchronizing our systems. Please try again.', color=0xf50000)
+    elif stats == None:
+        embed = discord.Embed(title= f'❌ No recorded games found for **{player.name}**.', color=0xf50000)
+    else:
+        embed = discord.Embed(title= f'Poker stats for **{player.name}**', color=0x800080)
+        embed.add_field(name='Net profit', value=format_profit(stats['net_cents']))
+        embed.add_field(name='Games played', value=str(stats['games_played']))
+        embed.add_field(name='Biggest win', value=format_profit(stats['biggest_win_cents']) if stats['biggest_win_cents'] > 0 else '-')
+        embed.add_field(name='Total buy-ins', value=f"${utilities.format_cents(stats['buy_in_cents'])}")
+    await interaction.response.send_message(embed=embed)
+
+
+@bot.tree.command(name="leaderboard", description='See the players with the highest Poker profit in this server')
+@app_commands.guild_only()
+@metrics.timed_command('leaderboard')
+@lifecycle.requires_database
+async def leaderboard_cmd(interaction):
+    leaders = await database.get_leaderboard(interaction.guild_id)
+    if leaders == None:
+        embed = discord.Embed(title= f'❌ Database Error', description= f'We encountered an error in synchronizing our systems. Please try again.', color=0xf50000)
+    elif len(leaders) == 0:
+        embed = discord.Embed(title= f'❌ No recorded games found in this server.', color=0xf50000)
+    else:
+        lines = [f"**{i + 1}.** <@{stats['player']}> {format_profit(stats['net_cents'])} ({stats['games_played']} games)" for i, stats in enumerate(leaders)]
+        embed = discord.Embed(title= f'🏆 Leaderboard', description='\n'.join(lines), color=0x800080)
+    await interaction.response.send_message(embed=embed)
 
 
 
@@ -537,4 +820,12 @@ async def payout_cmd(interaction):
 #     print(ctx)
 
 #--RUN--#
-bot.run(DISCORD_TOKEN)
\ No newline at end of file
+if __name__ == '__main__':
+    settlement_result_cache.load()
+    settlement_executor.start()
+    try:
+        bot.run(DISCORD_TOKEN, log_handler=None) #logging is already configured by metrics.configure_logging
+    finally:
+        settlement_executor.shutdown()
+        settlement_result_cache.save()
+        game_outbox.close()
\ No newline at end of file
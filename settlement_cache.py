@@ -0,0 +1,95 @@
+import os
+import json
+import logging
+import utilities
+
+#--SETTLEMENT RESULT CACHE--#
+#Poker nights repeat the same shapes (fixed buy-ins, a handful of distinct results), and the optimal settlement only depends
+#on the multiset of debts, not on who holds them. So results are cached under the sorted cent debts, stored as transaction
+#patterns over positions in that sorted order (which also encodes the zero-sum grouping) and mapped back onto whichever
+#players hold those debts next time. Players with equal debts are interchangeable, so any tie order maps back correctly.
+
+log = logging.getLogger(__name__)
+
+
+def get_canonical_debts(game_data):
+    """
+    Return value: (key, player ids in key order) where key is the tuple of sorted nonzero cent debts,
+    or None if the game does not sum to zero
+    """
+    data = utilities.get_player_debts(game_data)
+    if data == None:
+        return None
+
+    data.sort(key=lambda row: row[1])
+    return tuple(row[1] for row in data), [row[0] for row in data]
+
+
+class SettlementCache:
+    """
+    LRU cache of settlement results keyed by the canonical debt multiset, optionally saved to a JSON file at path
+    (load() on startup, save() periodically and on shutdown) so it survives restarts.
+    """
+
+    def __init__(self, maxsize=4096, path=None):
+        self.entries = utilities.LRUTTLCache(maxsize=maxsize, ttl=float('inf')) #a settlement never goes stale
+        self.path = path
+
+    def get(self, game_data):
+        """Return value: the cached transactions mapped onto game_data's players, or None on a miss (or an invalid game)"""
+        canonical = get_canonical_debts(game_data)
+        if canonical == None:
+            return None
+
+        key, players = canonical
+        pattern = self.entries.get(key)
+        if pattern == None:
+            return None
+
+        return [[players[debtor], players[recipient], amount_cents] for debtor, recipient, amount_cents in pattern]
+
+    def set(self, game_data, transactions):
+        """Store the transactions poker_debt_settlement_algo returned for game_data as a pattern over its canonical debts."""
+        canonical = get_canonical_debts(game_data)
+        if canonical == None or transactions == None:
+            return
+
+        key, players = canonical
+        position = {player_id: i for i, player_id in enumerate(players)}
+        self.entries.set(key, tuple((position[debtor], position[recipient], amount_cents) for debtor, recipient, amount_cents in transactions))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_stats(self):
+        return self.entries.get_stats()
+
+    def load(self):
+        """Fill the cache from path if it exists. Return value: number of loaded entries"""
+        if self.path == None or not os.path.exists(self.path):
+            return 0
+
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+            for key, pattern in stored:
+                self.entries.set(tuple(key), tuple(tuple(transaction) for transaction in pattern))
+        except (OSError, ValueError, TypeError) as e:
+            log.warning(f"Could not load the settlement cache from {self.path}: {e}")
+            return 0
+
+        log.info(f"Loaded {len(stored)} cached settlements", extra={"path": self.path})
+        return len(stored)
+
+    def save(self):
+        """Write every entry (least recently used first, so load() keeps the recency order) to path, atomically."""
+        if self.path == None:
+            return
+
+        try:
+            temporary = f"{self.path}.tmp"
+            with open(temporary, "w") as f:
+                json.dump([[key, pattern] for key, (expiry, pattern) in self.entries.entries.items()], f)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            log.warning(f"Could not save the settlement cache to {self.path}: {e}")
@@ -0,0 +1,180 @@
+import asyncio
+import time
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import utilities
+import metrics
+
+log = logging.getLogger(__name__)
+
+#--SETTLEMENT EXECUTOR SERVICE--#
+#Runs the (exponential worst case) debt settlement algorithm in worker processes so the discord.py event loop never blocks on it.
+#Workers come from a forkserver (spawn where that's unavailable) rather than a fork of the running bot, which holds an
+#event loop and motor's background threads that a forked child would inherit in whatever state they were in.
+
+
+class SettlementExecutor:
+    """
+    Process pool backed settlement service with a per-call time budget.
+    If the budget is exceeded the call is cancelled (or abandoned if a worker already started it) and the
+    game is settled with the greedy algorithm instead, so a command always gets an answer in about time_budget seconds.
+    With a settlement_cache.SettlementCache, game shapes that were settled before are answered from it without touching the pool.
+    """
+
+    def __init__(self, max_workers=2, time_budget=2.0, latency_window=500, cache=None, max_abandoned_pools=2):
+        self.maxWorkers = max_workers
+        self.timeBudget = time_budget
+        self.pool = None
+        self.cache = cache
+        self.maxAbandonedPools = max_abandoned_pools
+        self.abandonedPools = [] #replaced pools still finishing runaway settlements
+        self.poolFutures = {} #pool -> set of its calls that have not finished yet
+        start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.mpContext = multiprocessing.get_context(start_method)
+
+        #metrics
+        self.queueDepth = 0 #calls submitted to the pool that have not finished yet
+        self.completed = 0
+        self.timeouts = 0
+        self.abandoned = 0 #timed out calls that were already running in a worker and could not be cancelled
+        self.failures = 0
+        self.latencies = deque(maxlen=latency_window) #seconds, most recent calls only
+
+    def start(self):
+        if self.pool == None:
+            self.pool = self._new_pool()
+
+    def shutdown(self):
+        if self.pool != None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+        for pool in self.abandonedPools:
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.abandonedPools = []
+        self.poolFutures = {}
+
+    def _new_pool(self):
+        pool = ProcessPoolExecutor(max_workers=self.maxWorkers, mp_context=self.mpContext)
+        self.poolFutures[pool] = set()
+        return pool
+
+    def _submit(self, game_data):
+        """Return value: (pool, concurrent future) of poker_debt_settlement_algo(game_data) on the current pool"""
+        try:
+            future = self.pool.submit(utilities.poker_debt_settlement_algo, game_data)
+        except BrokenProcessPool: #a worker died since the last call
+            self._replace_broken_pool(self.pool)
+            future = self.pool.submit(utilities.poker_debt_settlement_algo, game_data)
+
+        pool = self.pool
+        pending = self.poolFutures[pool]
+        pending.add(future)
+        future.add_done_callback(pending.discard)
+        return pool, future
+
+    def _recycle_pool(self):
+        """
+        A running worker can't be interrupted, so hand new work to a fresh pool and let the old one finish and exit on its own.
+        Calls queued in the old pool stay there, their callers are still waiting on them and fall back to greedy on their own budget.
+        At most max_abandoned_pools old pools are kept running, past that new work keeps queueing on the current pool.
+        """
+        self.abandonedPools = [pool for pool in self.abandonedPools if len(self.poolFutures[pool]) > 0]
+        for pool in list(self.poolFutures):
+            if pool != self.pool and pool not in self.abandonedPools:
+                del self.poolFutures[pool]
+
+        if len(self.abandonedPools) >= self.maxAbandonedPools:
+            log.warning("Too many settlement pools still running abandoned calls, not replacing the pool", extra={"abandoned_pools": len(self.abandonedPools)})
+            return
+
+        old_pool = self.pool
+        self.pool = self._new_pool()
+        old_pool.shutdown(wait=False, cancel_futures=False)
+        self.abandonedPools.append(old_pool)
+
+    def _replace_broken_pool(self, pool):
+        #a worker was killed (out of memory, signal): the pool refuses every call from then on, so start a new one
+        if pool != self.pool:
+            return #another call already replaced it
+        log.warning("Settlement worker died, replacing the process pool")
+        self.pool = self._new_pool()
+        pool.shutdown(wait=False, cancel_futures=False)
+        del self.poolFutures[pool]
+
+    async def settle(self, game_data, time_budget=None):
+        """
+        Run utilities.poker_debt_settlement_algo(game_data) in the process pool.
+        Falls back to utilities.greedy_debt_settlement(game_data) if it takes longer than time_budget seconds.
+        Same return value as poker_debt_settlement_algo. Exceptions from the algorithm are re-raised.
+        """
+        async with metrics.stage("settlement"):
+            if self.cache != None:
+                transactions = self.cache.get(game_data)
+                if transactions != None:
+                    return transactions
+            return await self._settle(game_data, time_budget)
+
+    async def _settle(self, game_data, time_budget):
+        self.start()
+        if time_budget == None:
+            time_budget = self.timeBudget
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        self.queueDepth += 1
+        pool, future = self._submit(game_data)
+
+        try:
+            transactions = await asyncio.wait_for(asyncio.wrap_future(future, loop=loop), timeout=time_budget)
+            if self.cache != None:
+                self.cache.set(game_data, transactions) #only results of the full algorithm, never the greedy fallback
+            return transactions
+
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            if not future.cancel(): #already running in a worker
+                self.abandoned += 1
+                if pool == self.pool: #calls left running in an abandoned pool don't need another one
+                    self._recycle_pool()
+            log.warning(f"Settlement exceeded its {time_budget}s budget, falling back to greedy settlement", extra={"players": len(game_data)})
+            return utilities.greedy_debt_settlement(game_data)
+
+        except BrokenProcessPool:
+            self.failures += 1
+            self._replace_broken_pool(pool)
+            log.warning("Settlement worker died, falling back to greedy settlement", extra={"players": len(game_data)})
+            return utilities.greedy_debt_settlement(game_data)
+
+        except Exception:
+            self.failures += 1
+            raise
+
+        finally:
+            self.queueDepth -= 1
+            self.completed += 1
+            self.latencies.append(time.perf_counter() - start)
+
+    def get_metrics(self):
+        """Snapshot of queue depth and latency metrics (latencies in seconds over the recent window)."""
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if len(latencies) == 0:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))]
+
+        return {
+            "queue_depth": self.queueDepth,
+            "completed": self.completed,
+            "timeouts": self.timeouts,
+            "abandoned": self.abandoned,
+            "abandoned_pools": len(self.abandonedPools),
+            "failures": self.failures,
+            "latency_p50": percentile(0.50),
+            "latency_p99": percentile(0.99),
+            "latency_max": latencies[-1] if len(latencies) > 0 else 0.0,
+            "cache": self.cache.get_stats() if self.cache != None else None,
+        }
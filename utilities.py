@@ -1,34 +1,204 @@
-import discord
-import asyncio
-from itertools import combinations
-from functools import reduce
-from collections import defaultdict
+import logging
+import time
+from collections import defaultdict, OrderedDict
+from array import array
+from math import comb
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+import csv
+import json
 
-async def can_dm_user(member: discord.User):
-    if member.dm_channel == None:
-        await member.create_dm()
+EXACT_SETTLEMENT_MAX_PLAYERS = 16 #above this many (nonzero, unpaired) debts the O(2^n * n) exact DP is too slow and the bounded heuristic is used
+HEURISTIC_SUBSET_BUDGET = 500_000 #max number of candidate subsets the heuristic fallback is allowed to enumerate
+
+log = logging.getLogger(__name__)
+
+class LRUTTLCache:
+    """
+    Bounded in-memory cache with least recently used eviction and a per-entry time to live (seconds).
+    Keeps hit/miss counters so callers can report how much network I/O it saves.
+    """
+
+    def __init__(self, maxsize=1024, ttl=600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() #key -> (expiry time, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry == None or entry[0] < time.monotonic():
+            if entry != None: #expired
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry != None and entry[0] >= time.monotonic()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_stats(self):
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+def to_cents(amount) -> int:
+    """Convert a dollar amount (float/str/Decimal from a command parameter) to integer cents, rounding half up."""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+def format_cents(cents: int) -> str:
+    """Format integer cents as a dollar string with 2 decimals (e.g. 1205 -> '12.05')."""
+    sign = '-' if cents < 0 else ''
+    return f'{sign}{abs(cents) // 100}.{abs(cents) % 100:02d}'
+
+def parse_game_row(line_number, player, buy_in, winnings):
+    """Validate one imported [player, buy_in, winnings] row. Return value: (line_number, player, buy_in_cents, winnings_cents)"""
+    player = str(player).strip()
+    if len(player) == 0:
+        raise ValueError(f'Row {line_number}: missing player')
 
     try:
-        await member.dm_channel.send() #send empty message to see if forbidden (cant dm user) or just throws an error because of empty content
-    except discord.Forbidden:
-        return False
-    except discord.HTTPException:
-        return True
-    
+        buy_in_cents = to_cents(str(buy_in).strip())
+        winnings_cents = to_cents(str(winnings).strip())
+    except (InvalidOperation, ValueError):
+        raise ValueError(f'Row {line_number}: buy-in and winnings must be numbers')
+
+    if buy_in_cents < 0 or winnings_cents < 0:
+        raise ValueError(f'Row {line_number}: buy-in and winnings can\'t be negative')
+
+    return line_number, player, buy_in_cents, winnings_cents
 
-def find_zero_sum_subsets(debts, k, epsilon=1e-9):
-    """Find all subsets of size <= k whose sum is close to zero."""
-    zero_sum_subsets = []
-    for size in range(2, k + 1):
-        for subset in combinations(enumerate(debts), size):
-            indices, subset_debts = zip(*subset)
-            if abs(sum(subset_debts)) < epsilon:
-                zero_sum_subsets.append(indices)
-    return zero_sum_subsets
-
-def k_set_packing_approximation(debts, k, epsilon=1e-9):
-    """Implement k-set packing approximation."""
-    zero_sum_subsets = find_zero_sum_subsets(debts, k, epsilon)
+def parse_game_csv(lines):
+    """
+    Stream-parse "player,buy_in,winnings" CSV lines (any iterable of lines, e.g. a file), skipping blank lines and an optional header.
+    Yields (line_number, player, buy_in_cents, winnings_cents) one row at a time; raises ValueError naming the row if one is invalid.
+    """
+    reader = csv.reader(lines)
+    for row in reader:
+        if len(row) == 0 or all(len(cell.strip()) == 0 for cell in row):
+            continue
+        if len(row) != 3:
+            raise ValueError(f'Row {reader.line_num}: expected 3 columns (player, buy-in, winnings)')
+
+        if reader.line_num == 1 and not any(character.isdigit() for character in row[1]): #header row
+            continue
+
+        yield parse_game_row(reader.line_num, *row)
+
+def parse_game_json(text):
+    """
+    Parse a JSON list of {"player", "buy_in", "winnings"} objects (or [player, buy_in, winnings] lists).
+    Yields (row_number, player, buy_in_cents, winnings_cents); raises ValueError if the document or a row is invalid.
+    """
+    try:
+        rows = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f'Invalid JSON: {e}')
+
+    if not isinstance(rows, list):
+        raise ValueError('Expected a JSON list of players')
+
+    for i, row in enumerate(rows):
+        if isinstance(row, dict) and all(key in row for key in ("player", "buy_in", "winnings")):
+            yield parse_game_row(i + 1, row["player"], row["buy_in"], row["winnings"])
+        elif isinstance(row, list) and len(row) == 3:
+            yield parse_game_row(i + 1, *row)
+        else:
+            raise ValueError(f'Row {i + 1}: expected "player", "buy_in" and "winnings"')
+
+
+def parse_shard_ids(text):
+    """Parse a shard id list like "0,1" or "0-3,8" into a sorted list of ints. Raises ValueError if it is malformed."""
+    shard_ids = set()
+    for part in text.split(','):
+        part = part.strip()
+        if '-' in part:
+            first, last = part.split('-', 1)
+            shard_ids.update(range(int(first), int(last) + 1))
+        elif part != '':
+            shard_ids.add(int(part))
+    return sorted(shard_ids)
+
+class ZeroSumSubsetIndex:
+    """
+    Meet-in-the-middle index of zero-sum subsets of integer cent debts.
+    The debts are split into two halves and the partial sums of each half are hashed by subset size, so the zero-sum
+    subsets of a given size come from dictionary lookups (left sum s matches right sum -s) instead of summing every
+    combination. Each size is built once and cached, so escalating k only does the work for the new sizes.
+    """
+
+    def __init__(self, debts: list[int]):
+        self.debts = debts
+        self.split = len(debts) // 2
+        self.halves = [(0, self.split), (self.split, len(debts))] #index ranges of the left and right half
+        self.levels = [[{0: [()]}], [{0: [()]}]] #levels[half][size] is a dict of partial sum -> list of index tuples
+        self.frontiers = [[((), 0)], [((), 0)]] #all (index tuple, partial sum) of the last built size, to extend by one index
+        self.subsetsBySize = {}
+
+    def _half_level(self, half, size):
+        """Partial sums of all subsets of the given half with exactly size elements, built incrementally from size - 1."""
+        levels = self.levels[half]
+        start, end = self.halves[half]
+        while len(levels) <= size:
+            frontier = []
+            sums = defaultdict(list)
+            for indices, partial_sum in self.frontiers[half]:
+                first = indices[-1] + 1 if indices else start
+                for j in range(first, end):
+                    extended = (indices + (j,), partial_sum + self.debts[j])
+                    frontier.append(extended)
+                    sums[extended[1]].append(extended[0])
+            self.frontiers[half] = frontier
+            levels.append(sums)
+
+        return levels[size]
+
+    def subsets_of_size(self, size):
+        """All zero-sum subsets with exactly size elements as sorted index tuples, in lexicographic order."""
+        if size not in self.subsetsBySize:
+            zero_sum_subsets = []
+            for left_size in range(max(0, size - (len(self.debts) - self.split)), min(size, self.split) + 1):
+                left = self._half_level(0, left_size)
+                right = self._half_level(1, size - left_size)
+                for partial_sum, left_subsets in left.items():
+                    right_subsets = right.get(-partial_sum)
+                    if right_subsets:
+                        for left_subset in left_subsets:
+                            for right_subset in right_subsets:
+                                zero_sum_subsets.append(left_subset + right_subset) #left indices are all smaller, so still sorted
+
+            zero_sum_subsets.sort() #same order itertools.combinations would produce
+            self.subsetsBySize[size] = zero_sum_subsets
+
+        return self.subsetsBySize[size]
+
+    def subsets_up_to(self, k):
+        """All zero-sum subsets of size 2..k, smaller sizes first."""
+        zero_sum_subsets = []
+        for size in range(2, k + 1):
+            zero_sum_subsets.extend(self.subsets_of_size(size))
+        return zero_sum_subsets
+
+def k_set_packing_approximation(index: ZeroSumSubsetIndex, k):
+    """Implement k-set packing approximation over the zero-sum subsets of size <= k from a shared index."""
+    zero_sum_subsets = index.subsets_up_to(k)
     
     # Create a graph where nodes are people and edges are zero sum subsets
     graph = defaultdict(list)
@@ -52,26 +222,135 @@ def k_set_packing_approximation(debts, k, epsilon=1e-9):
     
     return transactions, used_indices
 
-def get_minimum_transaction_sets(debts, max_k=5, epsilon=1e-9):
+def get_minimum_transaction_sets(debts: list[int], max_k=5):
     """
     Get max disjoint zero sum sets using an adaptive k-set packing approximation.
     The return value will be all sets s such that in s.size() - 1 transactions the 
     set's debt can be settled. Across all sets this is the minimum number of
-    transactions needed to settle all debts. O(n^k) runtime.
+    transactions needed to settle all debts. O(n^k) worst case, but the zero-sum subsets come from
+    hash lookups on half-sized partial sums that are shared across every k.
     """
     n = len(debts)
+    index = ZeroSumSubsetIndex(debts) #built once, every k reuses the subset sums of the smaller sizes
     for k in range(2, max_k + 1):
-        transactions, used_indices = k_set_packing_approximation(debts, k, epsilon)
+        transactions, used_indices = k_set_packing_approximation(index, k)
         if len(used_indices) == n:
             return transactions, k
     
     # If max_k is reached and not all debts are settled, return the best found solution
     return transactions, max_k
 
-def greedy(debts: list[list[float,int]]):
+def get_bounded_max_k(n, max_k, subset_budget=HEURISTIC_SUBSET_BUDGET):
+    """
+    Largest k <= max_k such that enumerating every subset of size 2..k of n debts stays within subset_budget.
+    Keeps the heuristic fallback bounded for large games (C(30, 10) alone is 30 million subsets).
+    """
+    total = 0
+    bounded_k = 2
+    for k in range(2, max_k + 1):
+        total += comb(n, k)
+        if total > subset_budget:
+            break
+        bounded_k = k
+
+    return bounded_k
+
+def pair_opposite_debts(debts: list[int]):
+    """
+    Opposite debts (x and -x) can always be paired off in an optimal solution, so pair them before any exponential search.
+    Return value: (list of index pairs, sorted list of indices that were left unpaired)
+    """
+    pairs = []
+    unpaired = defaultdict(list) #debt value -> indices still waiting for a partner
+    for i, debt in enumerate(debts):
+        if unpaired[-debt]:
+            pairs.append((unpaired[-debt].pop(), i))
+        else:
+            unpaired[debt].append(i)
+
+    remaining = sorted(i for indices in unpaired.values() for i in indices)
+    return pairs, remaining
+
+def exact_zero_sum_packing(debts: list[int]):
+    """
+    Exact maximum zero-sum set packing using a subset-sum bitmask DP over integer cents.
+    dp[mask] is the maximum number of zero-sum sets along the best chain of zero-sum subsets inside mask, so
+    dp[full] is the maximum number of sets the debts can be partitioned into. O(2^n * n) time, O(2^n) memory in compact arrays.
+    debts must sum to zero. Return value: list of tuples of indices into debts, each a zero-sum set, covering every index.
     """
-    Greedy algo
-    Return value: list of lists where each sublist has the form [player_id_debtor, player_id_recipient, amount]
+    n = len(debts)
+    if n == 0:
+        return []
+
+    full = (1 << n) - 1
+
+    #subset sums: each mask is its lowest set bit plus a smaller, already computed mask
+    sums = array('q', bytes(8 * (full + 1)))
+    for mask in range(1, full + 1):
+        low = mask & -mask
+        sums[mask] = sums[mask ^ low] + debts[low.bit_length() - 1]
+
+    bits = [1 << i for i in range(n)]
+    dp = array('b', bytes(full + 1))
+    for mask in range(1, full + 1):
+        best = 0
+        for bit in bits:
+            if mask & bit:
+                prev = dp[mask ^ bit]
+                if prev > best:
+                    best = prev
+        dp[mask] = best + 1 if sums[mask] == 0 else best
+
+    #walk back down from the full set, closing a set every time the remaining mask sums to zero
+    zero_sum_sets = []
+    mask = full
+    group = []
+    while mask:
+        target = dp[mask] - 1 if sums[mask] == 0 else dp[mask]
+        for i in range(n):
+            bit = bits[i]
+            if mask & bit and dp[mask ^ bit] == target:
+                group.append(i)
+                mask ^= bit
+                break
+
+        if sums[mask] == 0:
+            zero_sum_sets.append(tuple(sorted(group)))
+            group = []
+
+    return sorted(zero_sum_sets)
+
+def get_zero_sum_sets(debts: list[int], max_k=10, exact_max_players=EXACT_SETTLEMENT_MAX_PLAYERS):
+    """
+    Split integer cent debts into the maximum number of zero-sum sets we can find.
+    Opposite debts are paired first, then the rest uses the exact bitmask DP when there are at most exact_max_players of them,
+    otherwise the adaptive k-set packing heuristic with k bounded so the subset enumeration stays within HEURISTIC_SUBSET_BUDGET.
+    Return value: (list of tuples of indices, chosen_k) where chosen_k is None if the exact DP was used.
+    Every index of debts is guaranteed to be in exactly one returned set.
+    """
+    pairs, remaining = pair_opposite_debts(debts)
+    values = [debts[i] for i in remaining]
+
+    if len(remaining) <= exact_max_players:
+        local_sets = exact_zero_sum_packing(values)
+        chosen_k = None
+    else:
+        bounded_k = get_bounded_max_k(len(values), max_k)
+        local_sets, chosen_k = get_minimum_transaction_sets(values, bounded_k)
+
+        #whatever the heuristic could not place sums to zero as a whole (every other set sums to zero), so settle it as one set
+        used_indices = set(index for zero_sum_set in local_sets for index in zero_sum_set)
+        leftover = tuple(i for i in range(len(values)) if i not in used_indices)
+        if len(leftover) > 0:
+            local_sets = local_sets + [leftover]
+
+    zero_sum_sets = pairs + [tuple(remaining[i] for i in zero_sum_set) for zero_sum_set in local_sets]
+    return sorted(zero_sum_sets), chosen_k
+
+def greedy(debts: list[list[int]]):
+    """
+    Greedy algo over [player_id, debt_cents] rows
+    Return value: list of lists where each sublist has the form [player_id_debtor, player_id_recipient, amount_cents]
     """
 
     #sort in ascending order (max creditor, .., max debtor)
@@ -80,7 +359,7 @@ def greedy(debts: list[list[float,int]]):
     currCreditorIdx = 0
     currDebtorIdx = len(debts) - 1
 
-    transactions = [0 for i in range(len(debts) - 1)] # n-1 transactions to settle all debts
+    transactions = [0 for i in range(len(debts) - 1)] # at most n-1 transactions to settle all debts
     iterator = 0
 
     while currCreditorIdx < currDebtorIdx:
@@ -90,13 +369,13 @@ def greedy(debts: list[list[float,int]]):
         if abs(debts[currCreditorIdx][1]) < debts[currDebtorIdx][1]:
 
             transactions[iterator][2] = abs(debts[currCreditorIdx][1])
-            debts[currDebtorIdx][1] = round(debts[currDebtorIdx][1] + debts[currCreditorIdx][1], 2)
+            debts[currDebtorIdx][1] = debts[currDebtorIdx][1] + debts[currCreditorIdx][1]
             currCreditorIdx = currCreditorIdx + 1
 
         elif abs(debts[currCreditorIdx][1]) > debts[currDebtorIdx][1]:
 
             transactions[iterator][2] = debts[currDebtorIdx][1]
-            debts[currCreditorIdx][1] = round(debts[currCreditorIdx][1] + debts[currDebtorIdx][1], 2)
+            debts[currCreditorIdx][1] = debts[currCreditorIdx][1] + debts[currDebtorIdx][1]
             currDebtorIdx = currDebtorIdx - 1
             
         else:
@@ -107,40 +386,65 @@ def greedy(debts: list[list[float,int]]):
 
         iterator = iterator + 1
  
-    return transactions
+    return transactions[:iterator] #fewer than n-1 when debts cancel exactly along the way
+
+
+def get_player_debts(game_data):
+    """
+    Turn [player_id, player_buy_in_cents, player_winnings_cents] rows into [player_id, debt_cents] rows
+    (positive if they are in debt and owe, negative if have credit and are owed), dropping players who owe and receive nothing.
+    Return value: the debt rows, or None if the total amount owed among everyone does not equal 0
+    """
+    data = []
+    for player_info in game_data:
+        player_debt = player_info[1] - player_info[2]
+
+        if player_debt != 0:
+            data.append([player_info[0], player_debt])
+
+    if sum(row[1] for row in data) != 0:
+        return None
 
+    return data
 
-def poker_debt_settlement_algo(game_data):
+def greedy_debt_settlement(game_data):
+    """
+    Settle a whole game with a single greedy pass (at most n - 1 transactions, O(nlogn), no zero-sum set search).
+    Used as the fallback when the full settlement algorithm runs out of time. Same input/output as poker_debt_settlement_algo.
+    """
+    data = get_player_debts(game_data)
+    if data == None:
+        return None
+
+    return greedy(data)
+
+
+def poker_debt_settlement_algo(game_data, stats=None):
     """
     Debt Settlement Algorithm, which reduces to the Optimal Zero-Sum Set Packing problem 
     (Finding the maximum number of zero sum sets you can partition X = [debt1, debt2, ...] into is 
     equivalent to finding the minimum number of transactions)
 
-    game_data is a list of lists, where each list has the form [player_id, player_buy_in, player_winnings]
-
-    The algorithm is a Greedy algorithm that uses a max_heap and min_heap to reduce
-    the time complexity to O(nlogn)
+    game_data is a list of lists, where each list has the form [player_id, player_buy_in_cents, player_winnings_cents]
+    Return value: list of [player_id_debtor, player_id_recipient, amount_cents], or None if the game does not sum to zero
 
-    OR
+    The zero-sum sets are found exactly with a subset-sum bitmask DP over integer cents (O(2^n * n)) for up to
+    EXACT_SETTLEMENT_MAX_PLAYERS unpaired debts, and with a bounded adaptive k-set packing heuristic above that.
+    Within each zero-sum set, a greedy pass decides who pays who (set.size() - 1 transactions).
 
-    The algorithm is a brute force approach 
+    If a stats dict is passed, it is filled with "zero_sum_sets" and "chosen_k" (None when the exact DP was used).
 
     """
     
     #get player debts (positive if they are in debt and owe, negative if have credit and are owed) and clean out any 0's (people who owe and receive nothing)
-    data = []
-    for player_info in game_data:
-        player_debt = round(player_info[1] - player_info[2], 2)
-
-        if player_debt != 0:
-            data.append([player_info[0], player_debt])
-  
-    debts = [row[1] for row in data]
+    data = get_player_debts(game_data)
 
     #if total amount owed among everyone does not equal 0, there is an error in provided values
-    if round(sum(debts), 2) != 0:
+    if data == None:
         return None
 
+    debts = [row[1] for row in data]
+
 
     # debts = [10, 49, 50, 65, -75, -99, 27, -7, -10, -10, 10, 39, 50, 65, -75, -89, 31, -7, -14, -10]
     # debts = [5, 5, 5, 5, 5]
@@ -148,12 +452,15 @@ def poker_debt_settlement_algo(game_data):
     # debts = [-1.47, .22, 1.12, -.61, .76, -1.40, .19, 1.16, -.75, .78]
 
     max_k = 10
-    transactions, chosen_k = get_minimum_transaction_sets(debts, max_k) #returns indices of the groups
-    print("Transactions to settle debts:", transactions)
-    print("Chosen k:", chosen_k)
+    transactions, chosen_k = get_zero_sum_sets(debts, max_k) #returns indices of the groups
+    log.debug(f"Zero-sum sets to settle debts: {transactions}", extra={"chosen_k": chosen_k if chosen_k != None else "exact"})
+    if stats != None:
+        stats["zero_sum_sets"] = len(transactions)
+        stats["chosen_k"] = chosen_k
 
-    final_transactions = [0 for i in range(len(data) - len(transactions))] #total number of transactions across all zero sum sets is n - k where k is number of zero sum sets
-    iterator = 0
+    #at most n - k transactions across all zero sum sets where k is number of zero sum sets (fewer if the heuristic's leftover set
+    #still splits into smaller zero sum sets, which greedy then closes early)
+    final_transactions = []
 
     #THEN DO GREEDY TO DETERMINE WHO WITHIN A ZERO-SUM-SET PAYS WHO (guaranteed to be minimal)
     for zero_sum_set in transactions:
@@ -162,14 +469,11 @@ def poker_debt_settlement_algo(game_data):
         for i in range(len(zero_sum_set)):
             groupedData[i] = data[zero_sum_set[i]]
 
-        res = greedy(groupedData)
-        for transaction in res:
-            final_transactions[iterator] = transaction
-            iterator = iterator + 1
+        final_transactions.extend(greedy(groupedData))
 
     return final_transactions
 
 
-#print(poker_debt_settlement_algo([[1,2.5,0],[3,4.35,0],[4,-6.85,0]]))
-#print(poker_debt_settlement_algo([[1,2.5,0],[3,4.35,0],[4,-6.85,0],[7,4,4]]))
-#print(poker_debt_settlement_algo([[1,2.5,0],[4,-2.8,0],[4,2.8,0],[3,4.35,0],[4,-6.85,0]]))
+#print(poker_debt_settlement_algo([[1,250,0],[3,435,0],[4,-685,0]]))
+#print(poker_debt_settlement_algo([[1,250,0],[3,435,0],[4,-685,0],[7,400,400]]))
+#print(poker_debt_settlement_algo([[1,250,0],[4,-280,0],[4,280,0],[3,435,0],[4,-685,0]]))